@@ -0,0 +1,219 @@
+#! /usr/bin/python3
+
+""" Run the whole pipeline, stages and samples in parallel
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+Instead of running the numbered scripts by hand, one after another,
+this script runs each stage as soon as the output it needs is there:
+the stages that go lane by lane, or sample by sample, are started
+separately for each lane (or sample), so that, for example, one sample
+can be aligning while the other is already in duplicate cleanup, and
+the lanes of a sample are trimmed and aligned in parallel. The lanes of
+a sample are merged (06_lane_merge.py) before the duplicate cleanup, and
+the stages that compare the samples wait for all of them. At most
+Config.max_parallel_jobs jobs run at the same time, and they share the
+cores (each job sizes its threads and workers by Config.job_cores). The
+output of each job is kept in the logs directory.
+
+A job whose input files, tools, relevant config fields and script did
+not change since its last successful run is not run again (see
+buildcache.py; the signatures are kept in the .buildcache directory -
+remove it to force the full rerun). Note that the changes in the utility
+modules (fastqc.py, pileup.py, ...) are not tracked.
+
+With Config.bwa_shm, the bwa index is loaded into the shared memory by
+the first alignment job, used by all of them, and dropped at the end.
+
+The graph with the depth and coverage (11_depth_and_coverage.py) is
+interactive and is not run here.
+
+This this script assumes the directory tree of the format
+.
+├── python
+└── task_dna
+
+Optionally, the (lane) rootnames can be given on the command line, to
+process only a subset of the samples in config.py.
+
+"""
+
+from utils import *
+from scheduler import *
+from buildcache import BuildCache
+from reference import reference_dir, bwa_shm_loaded, bwa_shm_drop
+from pileup import coverage_summary, pileup_consolidated, pileup_index
+
+
+# stage script, runs lane by lane, sample by sample, or for all samples at once (None),
+# stages whose output it needs, rough relative running time
+stages = [
+	["01_fastq_quality_check.py", "lane",   [], 1],
+	["03_adapter_cleanup.py",     "lane",   ["01_fastq_quality_check.py"], 2],
+	["04_reference_index.py",     None,     [], 1],
+	["05_alignment.py",           "lane",   ["03_adapter_cleanup.py", "04_reference_index.py"], 10],
+	["06_lane_merge.py",          "sample", ["05_alignment.py"], 1],
+	["07_duplicate_cleanup.py",   "sample", ["06_lane_merge.py"], 5],
+	["08_last_fastq_check.py",    "sample", ["07_duplicate_cleanup.py"], 1],
+	["10_pileup_for_coverage.py", None,     ["07_duplicate_cleanup.py"], 3],
+	["14_pileup_for_variants.py", "sample", ["07_duplicate_cleanup.py", "04_reference_index.py",
+											"10_pileup_for_coverage.py"], 5],
+	["15_callable_variants.py",   None,     ["10_pileup_for_coverage.py", "14_pileup_for_variants.py"], 2],
+	["16_annotation2bed.py",      None,     ["10_pileup_for_coverage.py"], 1],
+	["17_gene_annotation.py",     None,     ["16_annotation2bed.py"], 1],
+	["20_excel.py",               None,     ["10_pileup_for_coverage.py", "15_callable_variants.py",
+											"17_gene_annotation.py"], 1],
+]
+
+
+aligned = alignment_suffixes[Config.alignment_output]
+# the coverage files 10_pileup_for_coverage.py writes, besides the merged regions (see pileup.py);
+# without Config.pileup_consolidated, there is a pileup file for each region
+if Config.coverage_engine == "depth":
+	coverage_outputs = ["depth_regions.bed", coverage_summary]
+elif Config.pileup_consolidated:
+	coverage_outputs = [pileup_consolidated, pileup_index]
+else:
+	coverage_outputs = ["pileup_chr*.tsv"]
+
+# input and output glob patterns, relative to the home directory ({lane} is the lane rootname, {sample}
+# the sample name, and {config} the Config), tools and config fields that the result of each stage depends on;
+# listed_outputs are the output files that list further outputs (when which files come out depends on the data)
+stage_io = {
+	"01_fastq_quality_check.py": {"inputs": ["task_dna/{lane}_*.fastq*"],
+								"outputs": ["fastqc/first_pass/{lane}_*_fastqc.zip"],
+								"tools": ["fastqc"], "config": ["read_labels", "fastqc_engine", "fastq_stats_memory"]},
+	"03_adapter_cleanup.py":     {"inputs": ["task_dna/{lane}_*.fastq*", "fastqc/first_pass/{lane}_*_fastqc.zip"],
+								# the record lists the trimmed fastqs, clean_fastq/{lane}_trimmed_*.fastq.gz,
+								# or says there were no adapters to remove; the files it lists are outputs too
+								"outputs": ["clean_fastq/{lane}.trimming.tsv"],
+								"listed_outputs": ["clean_fastq/{lane}.trimming.tsv"],
+								"tools": ["cutadapt", "fastqc"],
+								"config": ["read_labels", "fastqc_engine", "fastq_stats_memory",
+											"cutadapt_cores", "trimmed_compression_level",
+											"adapter_seq", "adapter_discovery", "adapter_sample_reads",
+											"adapter_kmer", "adapter_tail_length", "adapter_min_fraction",
+											"adapter_consensus", "adapter_max_length"]},
+	"04_reference_index.py":     {"inputs": ["{config.reference_fasta}"],
+								"outputs": [reference_dir(Config.reference_fasta) + "/manifest.json"],
+								"tools": ["bwa", "samtools"], "config": ["reference_cache_dir"]},
+	"05_alignment.py":           {"inputs": ["task_dna/{lane}_*.fastq*", "clean_fastq/{lane}.trimming.tsv",
+											"clean_fastq/{lane}_trimmed_*.fastq.gz",
+											"{config.reference_fasta}"],
+								"outputs": ["alignments/{lane}" + aligned],
+								"tools": ["bwa", "samtools"],
+								"config": ["read_labels", "alignment_output"]},
+	"06_lane_merge.py":          {"inputs": ["alignments/{lane}" + aligned],
+								"outputs": ["alignments/{sample}" + aligned],
+								"tools": ["samtools"], "config": ["paired_reads_rootnames", "alignment_output"]},
+	"07_duplicate_cleanup.py":   {"inputs": ["alignments/{sample}" + aligned],
+								"outputs": ["alignments/{sample}.dedup.bam", "alignments/{sample}.dedup.bam.bai"],
+								"tools": ["samtools"], "config": ["alignment_output", "dedup_mode"]},
+	"08_last_fastq_check.py":    {"inputs": ["alignments/{sample}.dedup.bam"],
+								"outputs": ["fastqc/dedup/{sample}_*_fastqc.zip"],
+								"tools": ["samtools", "fastqc"],
+								"config": ["read_labels", "fastqc_engine", "fastq_stats_memory"]},
+	"10_pileup_for_coverage.py": {"inputs": ["alignments/{sample}.dedup.bam", "task_dna/{sample}_target.txt"],
+								"outputs": ["pileup/coverage/merged_target_regions.bed"]
+											+ [f"pileup/coverage/{fnm}" for fnm in coverage_outputs],
+								"tools": ["samtools"], "config": ["coverage_engine", "pileup_consolidated"]},
+	"14_pileup_for_variants.py": {"inputs": ["alignments/{sample}.dedup.bam", "{config.reference_fasta}",
+											"pileup/coverage/merged_target_regions.bed"],
+								"outputs": ["pileup/variants/{sample}.dedup.vcf.gz"],
+								"tools": ["samtools", "bcftools"], "config": ["variant_shards"]},
+	"15_callable_variants.py":   {"inputs": ["pileup/coverage/merged_target_regions.bed",
+											"pileup/variants/{sample}.dedup.vcf.gz"],
+								"outputs": ["pileup/variants/calls_per_interval.tsv"],
+								"tools": [], "config": []},
+	"16_annotation2bed.py":      {"inputs": ["annotation/{config.annotation_gtf}", "pileup/coverage/merged_target_regions.bed"],
+								"outputs": ["annotation/target_regions_annotated.bed", "annotation/target_regions_annotated.npz"],
+								"tools": [], "config": ["annotation_features"]},
+	"17_gene_annotation.py":     {"inputs": ["annotation/target_regions_annotated.npz", "{config.basic_uniprot}"],
+								"outputs": ["annotation/gene_annotation.tsv"],
+								"tools": [], "config": []},
+	"20_excel.py":               {"inputs": ["pileup/coverage/*.tsv", "pileup/variants/calls_per_interval.tsv",
+											"annotation/target_regions_annotated.npz", "annotation/gene_annotation.tsv"],
+								"outputs": ["python/region_summary.xlsx"],
+								"tools": [], "config": []},
+}
+
+
+def io_patterns(home_path, patterns, lanes, samples):
+	expanded = []
+	for pattern in patterns:
+		# the stages that compare the samples depend on the files of each sample (or lane)
+		for lane in (lanes if "{lane}" in pattern else [None]):
+			for sample in (samples if "{sample}" in pattern else [None]):
+				path = pattern.format(lane=lane, sample=sample, config=Config)
+				expanded.append(path if os.path.isabs(path) else f"{home_path}/{path}")
+	return expanded
+
+
+def job_name(script, name):
+	stage = script.split(".")[0]
+	return f"{stage}.{name}" if name else stage
+
+
+def build_jobs(home_path, python_dir, rootnames):
+	level = {stage[0]: stage[1] for stage in stages}
+	lanes_of = group_lanes(rootnames)
+	jobs = {}
+	for [script, by, needs, weight] in stages:
+		interpreter = "bash" if script.endswith(".bash") else sys.executable
+		names = rootnames if by == "lane" else (list(lanes_of.keys()) if by == "sample" else [None])
+		for name in names:
+			# the stages for all samples get the selected rootnames too - without any, a stage
+			# would take all of Config.paired_reads_rootnames, not only those the runner waited for
+			cmd = [interpreter, f"{python_dir}/{script}"] + ([name] if name else rootnames)
+			job = Job(job_name(script, name), cmd, weight)
+			# the lanes and the samples this job is about
+			samples = [sample_name(name)] if name else list(lanes_of.keys())
+			lanes = [name] if by == "lane" else [lane for sample in samples for lane in lanes_of[sample]]
+			io = stage_io[script]
+			job.inputs  = io_patterns(home_path, io["inputs"], lanes, samples)
+			job.outputs = io_patterns(home_path, io["outputs"], lanes, samples)
+			job.listed_outputs = io_patterns(home_path, io.get("listed_outputs", []), lanes, samples)
+			job.tools   = io["tools"]
+			job.config_fields = io["config"]
+			for needed in needs:
+				if level[needed] == "lane":  # wait for the lanes of this job
+					job.deps.update([job_name(needed, lane) for lane in lanes])
+				elif level[needed] == "sample":  # wait for the samples of this job
+					job.deps.update([job_name(needed, sample) for sample in samples])
+				else:
+					job.deps.add(job_name(needed, None))
+			jobs[job.name] = job
+	return jobs
+
+
+def main():
+
+	home_path  = get_home_path()
+	python_dir = f"{home_path}/python"
+	log_dir    = f"{home_path}/logs"
+	rootnames  = get_rootnames()
+
+	check_exist([f"{python_dir}/{stage[0]}" for stage in stages])
+
+	jobs  = build_jobs(home_path, python_dir, rootnames)
+	cache = BuildCache(f"{home_path}/.buildcache")
+	# the alignment jobs leave the bwa index in the shared memory for each other (see 05_alignment.py)
+	os.environ["SEQINSPECTOR_RUNNER"] = "1"
+	shm_preloaded = Config.bwa_shm and bwa_shm_loaded(Config.bwa, Config.reference_fasta)
+	# the report is written to the python directory
+	[failed, not_run] = run_jobs(jobs, Config.max_parallel_jobs, log_dir, cwd=python_dir, cache=cache)
+	if Config.bwa_shm and not shm_preloaded and bwa_shm_loaded(Config.bwa, Config.reference_fasta):
+		bwa_shm_drop(Config.bwa)
+
+	if failed or not_run:
+		print(f"failed: {failed}")
+		print(f"not run because of the failures: {not_run}")
+		exit(1)
+	print("pipeline done")
+
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -19,7 +19,8 @@ This this script assumes the directory tree of the format
 └── task_dna
 
 where task_dna contains the fastq files (the name chosen to correspond
-with the original task folder).  This script will add directory called
+with the original task folder), plain (.fastq), gzipped (.fastq.gz) or
+bgzipped (.fastq.bgz).  This script will add directory called
 "fastqc." Other dependencies shoud be set in config.py.
 
 """
@@ -34,16 +35,15 @@ def main():
 	home_path = get_home_path()
 
 	fastqc = Config.fastqc
-	unzip  = Config.unzip
 	dna_dir = f"{home_path}/task_dna"
 	out_dir = f"{home_path}/fastqc/first_pass"
-	rootnames   = Config.paired_reads_rootnames
+	rootnames   = get_rootnames()
 	read_labels = Config.read_labels
 
 	if not os.path.exists(out_dir): os.makedirs(out_dir)
 
-	dependencies = [fastqc, unzip, dna_dir, out_dir]
-	check_exist(dependencies)
+	dependencies = [fastqc, dna_dir, out_dir]
+	check_exist(dependencies if Config.fastqc_engine == "fastqc" else [dna_dir, out_dir])
 	check_fastq_exist(dna_dir)
 
 	run_fastqc(dependencies, rootnames, read_labels)
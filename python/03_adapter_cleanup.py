@@ -7,8 +7,11 @@ Ivana Mihalek,  2020
 
 This script removes adapters from the fastq files that were flagged
 in the previous step (01_fastq_quality_check.py), and re-runs FastQC
-on the trimmed seqeunces. The trimmed seqeunces are stored in
+on the trimmed seqeunces. The trimmed seqeunces are stored (gzipped) in
 clean_fastq directory, and the new FastQC report in the fastqc/trimmed.
+For each lane, trimmed or not, clean_fastq/{lane}.trimming.tsv records
+the trimmed files (none if there were no adapters to remove), so that
+the alignment - and the pipeline runner - know what to expect there.
 
 Sources:
 https://github.com/marcelm/cutadapt/
@@ -31,90 +34,111 @@ with the original task folder). This script will add directory called
 # from utils import *
 # fastq-specific functions - imports utils
 from fastqc import *
+from adapters import find_adapters
 
 
-def parse_fastqc_output(fastqc_data_file):
-	retmsg = "ok"
-	inf = open(fastqc_data_file)
-	module_start = ">>Adapter Content"
-	module_end   = ">>END_MODULE"
-	reading = False
+def parse_fastqc_output(report):
+	# the list of the adapters FastQC finds notable
 	adapter_content = {}
-	column_name = []
-	for line in inf:
-		if line[:len(module_start)] == module_start:
-			if not "fail" in line: break # we're ok
-			reading = True
-			continue
-		if reading:
-			if module_end in line: break  # we're done
-			if line[0]=="#": # this is the header of the table
-				column_name = 	line[1:].strip().split("\t")
-				# the first column is position
-				for cn in column_name[1:]: adapter_content[cn] = 0
-			else:
-				if len(column_name)==0:
-					print(f"No header for adapter content table found in{fastqc_data_file}.")
-					exit()
-				field = line.strip().split("\t")
+	if "Adapter Content" in report.modules:
+		[status, column_name, rows] = report.modules["Adapter Content"]
+		if status == "fail":
+			# the first column is position
+			for cn in column_name[1:]: adapter_content[cn] = 0
+			for field in rows:
 				for i in range(1,len(column_name)):
-					adapter_content[column_name[1]] += float(field[i])
-
-	if adapter_content:
-		# TODO what's with this cutoff - what if more than one adapter shows up?
-		notable_adapters = [k for k in adapter_content.keys() if adapter_content[k]>1]
-		if len(notable_adapters)>1:
-			print(f"More than one adapter content notable in {fastqc_data_file}: {notable_adapters}")
-			print("I'm not equipped to handle this.")
-			exit()
-		retmsg  = notable_adapters[0]
-
-	return retmsg
-
-
-def run_cutadapt(cutadapt, adapter_seq, adapter_name, dna_dir, root, labels, out_dir):
-	if adapter_name not in adapter_seq or not adapter_seq[adapter_name]:
-		print(f"This piece of code is a stump: need to find systematic way to find adapter seqs.")
-		exit()
-	aseq = adapter_seq[adapter_name]
-	fastq   = [f"{dna_dir}/{root}_{label}.fastq" for label in labels]
-	trimmed = [f"{out_dir}/{root}_trimmed_{label}.fastq" for label in labels]
-
-	if not os.path.exists(trimmed[0]) or not os.path.exists(trimmed[1]):
-		print(f"running cutadapt for {fastq}")
-		cmd  = f"{cutadapt} --quiet -a {aseq} -A {aseq} -o {trimmed[0]} -p {trimmed[1]}  {fastq[0]} {fastq[1]}"
-		subprocess.call(["bash", "-c", cmd])
-		# TODO check nonempty output present after the run
-	else:
-		print(f"found {trimmed}")
+					adapter_content[column_name[i]] += float(field[i])
+
+	return [k for k in adapter_content.keys() if adapter_content[k]>1]
+
+
+def adapters_for_trimming(adapter_seq, adapter_names, fastq):
+	# the adapter sequences as found in the reads themselves, if we can find them,
+	# otherwise the sequences of the flagged adapters we know of
+	if Config.adapter_discovery:
+		found = find_adapters(fastq)
+		if found: return found
+	known = [adapter_seq[name] for name in sorted(adapter_names) if adapter_seq.get(name)]
+	if not known:
+		print(f"No adapter sequence found in {fastq}, and none of {adapter_names} is in Config.adapter_seq.")
+		exit(1)
+	return known
+
+
+def run_cutadapt(cutadapt, adapters, dna_dir, root, labels, out_dir):
+	# adapters: the list of adapter sequences for each of the labels (R1, R2)
+	# (whether the trimming needs to be redone is for the pipeline runner to decide - here we always run)
+	fastq   = [gz_alias(fastq_file(dna_dir, root, label), out_dir) for label in labels]
+	trimmed = [f"{out_dir}/{root}_trimmed_{label}.fastq.gz" for label in labels]
+	# cutadapt writes to the .part files (compressed, because the name ends in .gz),
+	# renamed only when it finished fine - a run that was killed leaves no trimmed files behind
+	partial = [f"{fnm}.part.gz" for fnm in trimmed]
+	# the record of the earlier run goes too, and is rewritten only if this one succeeds
+	for fnm in trimmed + partial + [trimming_record(out_dir, root)]:
+		if os.path.exists(fnm): os.remove(fnm)
+
+	print(f"running cutadapt for {fastq}")
+	# each adapter gets its own -a (R1) or -A (R2); cutadapt picks the best matching one for each read
+	adapter_options  = " ".join([f"-a {a}" for a in adapters[0]] + [f"-A {a}" for a in adapters[1]])
+	cmd  = f"{cutadapt} --quiet {adapter_options} --cores {Config.cutadapt_cores} "
+	cmd += f"--compression-level {Config.trimmed_compression_level} "
+	cmd += f"-o {partial[0]} -p {partial[1]}  {fastq[0]} {fastq[1]}"
+	if subprocess.call(["bash", "-c", cmd]) != 0:
+		print(f"cutadapt failed for {root}")
+		for fnm in partial:
+			if os.path.exists(fnm): os.remove(fnm)
+		exit(1)
+	for [part, fnm] in zip(partial, trimmed): os.rename(part, fnm)
 
 	return f"{root}_trimmed"
 
 
+def write_trimming_record(out_dir, root, labels, adapters):
+	# adapters: None if the lane did not need trimming - the record says so, rather than being absent
+	record = trimming_record(out_dir, root)
+	with open(f"{record}.tmp", "w") as outf:
+		print("#trimmed fastq\tadapters", file=outf)
+		if adapters is None:
+			print("# no adapters to remove", file=outf)
+		else:
+			for [label, label_adapters] in zip(labels, adapters):
+				print(f"{root}_trimmed_{label}.fastq.gz\t{','.join(label_adapters)}", file=outf)
+	os.replace(f"{record}.tmp", record)
+
+
+def remove_stale_trimmed(out_dir, root, labels):
+	# the trimmed files from an earlier run, when this time there is nothing to trim
+	for label in labels:
+		fnm = f"{out_dir}/{root}_trimmed_{label}.fastq.gz"
+		if os.path.exists(fnm): os.remove(fnm)
+
+
 def adapter_cleanup(cutadapt, adapter_seq, rootnames, read_labels, dna_dir, fastqc_out_dir, out_dir):
 	if not os.path.exists(out_dir): os.mkdir(out_dir)
 	flagged = {}
 	for root in rootnames:
 		for label in read_labels:
-			fastqc_data_file = f"{fastqc_dir(fastqc_out_dir, root, label)}/fastqc_data.txt"
-			check_exist([fastqc_data_file])
-			retmsg = parse_fastqc_output(fastqc_data_file)
-			if retmsg == "ok":
+			fastqc_zip = f"{fastqc_dir(fastqc_out_dir, root, label)}.zip"
+			check_exist([fastqc_zip])
+			notable_adapters = parse_fastqc_output(fastqc_report(fastqc_out_dir, root, label))
+			if not notable_adapters:
 				print(f"\t {root} {label} ok")
 				continue
-			else:
-				adapter = retmsg
-				print(f"\t {root} {label} problematic adapter: {adapter}")
-				if not root in flagged: flagged[root] = set()
-				flagged[root].add(adapter)
+			print(f"\t {root} {label} problematic adapter(s): {notable_adapters}")
+			if not root in flagged: flagged[root] = set()
+			flagged[root].update(notable_adapters)
 
 	trimmed_root_names = []
-	for root in flagged:
-		if len(flagged[root])>1:
-			print(f"{root} flagged for the presence of multiple addapters, ({flagged[root]}).")
-			print("I'm not equipped to deal with it - bailing out.")
-			exit()
-		new_root_name = run_cutadapt(cutadapt, adapter_seq, flagged[root].pop(), dna_dir, root, read_labels, out_dir)
+	for root in rootnames:
+		if root not in flagged:
+			remove_stale_trimmed(out_dir, root, read_labels)
+			write_trimming_record(out_dir, root, read_labels, None)
+			continue
+		# R1 and R2 are read from the opposite ends, so their adapters are not the same
+		adapters = [adapters_for_trimming(adapter_seq, flagged[root], fastq_file(dna_dir, root, label))
+					for label in read_labels]
+		new_root_name = run_cutadapt(cutadapt, adapters, dna_dir, root, read_labels, out_dir)
+		write_trimming_record(out_dir, root, read_labels, adapters)
 		trimmed_root_names.append(new_root_name)
 
 	return trimmed_root_names
@@ -124,8 +148,7 @@ def adapter_sanity_check(trimmed_dir,  trimmed_rootnames, read_labels, fastqc_ou
 	if not trimmed_rootnames: return
 	if not os.path.exists(fastqc_out_dir): os.mkdir(fastqc_out_dir)
 	fastqc = Config.fastqc
-	unzip = Config.unzip
-	fastqc_deps = [fastqc, unzip, trimmed_dir, fastqc_out_dir]
+	fastqc_deps = [fastqc, trimmed_dir, fastqc_out_dir]
 	run_fastqc(fastqc_deps, trimmed_rootnames, read_labels)
 	# check the summary file for each fastq
 	# print issues to stdout
@@ -143,7 +166,7 @@ def main():
 	clean_fastq_dir  = f"{home_path}/clean_fastq"
 	fastqc_this_dir  = f"{home_path}/fastqc/trimmed"  # the output in this round
 
-	rootnames   = Config.paired_reads_rootnames
+	rootnames   = get_rootnames()
 	read_labels = Config.read_labels
 
 	check_exist([cutadapt, dna_dir, fastqc_first_dir])
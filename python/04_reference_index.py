@@ -0,0 +1,43 @@
+#! /usr/bin/python3
+
+""" Index the reference genome
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+Both the alignment (05_alignment.py) and the variant calling
+(14_pileup_for_variants.py) need the reference indexed - bwa and
+samtools faidx indices, respectively. They check for the indices
+themselves, but when the pipeline runner processes several samples
+at the same time, the (hour long, for hg19) indexing should be done
+once, before any of the samples get to alignment. The indices are
+kept in the shared cache, Config.reference_cache_dir, and only the
+pieces that are missing or do not match their checksums are built;
+the indices already sitting next to the fasta are linked into the
+cache rather than rebuilt (see reference.py).
+
+Sources:
+https://github.com/lh3/bwa
+http://www.htslib.org/doc/samtools-faidx.html
+
+"""
+
+from utils import *
+from reference import *
+
+
+def main():
+
+	bwa = Config.bwa
+	samtools = Config.samtools
+	reference_fasta = Config.reference_fasta
+
+	check_exist([bwa, samtools, reference_fasta])
+
+	prepare_reference(reference_fasta, bwa, samtools)
+
+	return
+
+
+if __name__ == "__main__":
+	main()
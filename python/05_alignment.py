@@ -8,7 +8,16 @@ Ivana Mihalek,  2020
 This script alignes the fastq to the reference genome. Needed for
 the following step which is duplicate removal. It wil use
 trimmed fastq if available, otherwose fall back on the original
-fastq.
+fastq. Unless Config.alignment_output is "sam", the output of bwa is
+piped straight into bam (or, with "sorted", through fixmate into a
+coordinate sorted bam, ready for marking duplicates), without the
+intermediate sam on the disk. With "sharded", the read pairs are split
+into chunks that are aligned and sorted in parallel, each retried on its
+own if it fails, and then merged - this way a sample can use more cores
+than bwa threading scales to.
+
+Each lane (e.g. AH_S1_L001) is aligned separately, as its own read group,
+and the lanes of a sample are merged in the next step, 06_lane_merge.py.
 
 Sources:
 https://https://github.com/lh3/bwa
@@ -28,46 +37,52 @@ with the original task folder). This script will ad directory called
 
 
 
-import subprocess
+import subprocess, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import *
+from fastq_io import split_pairs
+from reference import *
 
 
 def find_fastq(rootnames, read_labels, dna_dir, clean_dir):
 	clean_fastq = {}
 	# do we have trimmed version for any of the sequences?
 	for root in rootnames:
+		record = trimming_record(clean_dir, root)
+		if os.path.exists(record):
+			# the adapter cleanup says which lanes it trimmed - those must not fall back to the untrimmed reads
+			trimmed = listed_files(record)
+			if trimmed:
+				check_exist(trimmed)
+				clean_fastq[root] = trimmed
+				continue
 		clean_fastq[root] = []
 		for label in read_labels:
 			# let's call this convention over configuration
-			orig_version    = f"{dna_dir}/{root}_{label}.fastq"
-			trimmed_version = f"{clean_dir}/{root}_trimmed_{label}.fastq"
-			if os.path.exists(trimmed_version):
+			orig_version    = fastq_file(dna_dir, root, label)
+			trimmed_version = fastq_file(clean_dir, f"{root}_trimmed", label)
+			if not os.path.exists(record) and os.path.exists(trimmed_version):
 				clean_fastq[root].append(trimmed_version)
 			elif os.path.exists(orig_version):
 				clean_fastq[root].append(orig_version)
 			else:
 				print(f"fastq file for {root} {label} not found. I looked in {clean_dir} and in {dna_dir}.")
-				exit()
+				exit(1)
 	return clean_fastq
 
 
-def check_reference_indexed(reference_fasta):
-	# this is a rough check - it does not take care of  situations like .sa file exists but is broken
-	# (.sa file is the last file created)
-	if not os.path.exists(reference_fasta+".sa"):
-		print(f"index file for {reference_fasta} not found - indexing")
-		cmd = f"{bwa} index -a bwtsw  {reference_fasta}"
-		subprocess.call(["bash", "-c", cmd])
+def read_group(root):
+	# each lane is its own read group within the sample, so that the lanes can be merged later
+	sample = sample_name(root)
+	return f"'@RG\\tID:{root}\\tSM:{sample}\\tLB:{sample}\\tPL:ILLUMINA'"
 
 
 def align(bwa, reference_fasta, clean_fastq, alignments, root):
 	samfile = f"{alignments}/{root}.sam"
 	# bwa will look for input_reference_fasta.sa etc for its indexed input
-	cmd = f"{bwa} mem {reference_fasta} {clean_fastq[root][0]} {clean_fastq[root][1]} > {samfile} 2> /dev/null"
-	print(cmd)
-	subprocess.call(["bash", "-c", cmd])
-	# TODO: check output
+	cmd = f"{bwa} mem -R {read_group(root)} {reference_fasta} {clean_fastq[root][0]} {clean_fastq[root][1]} > {samfile} 2> /dev/null"
+	run_or_exit(cmd, f"alignment of {root} failed", [samfile])
 	return samfile
 
 
@@ -76,9 +91,105 @@ def sam2bam(samtools, samfile):
 	# see http://www.htslib.org/doc/samtools-view.html
 	bamfile = samfile[:-3] + "bam"
 	cmd = f"{samtools} view -bS {samfile} > {bamfile} 2> /dev/null"
+	run_or_exit(cmd, f"converting {samfile} to bam failed", [bamfile])
+	return bamfile
+
+
+def bwa_pipe(bwa, samtools, reference_fasta, fastq_pair, bamfile, sort, bwa_threads, root):
+	# no sam on the disk: bwa output goes straight into samtools
+	# pipefail, so that the failure of bwa is not masked by samtools finishing fine
+	bwa_cmd = f"{bwa} mem -t {bwa_threads} -R {read_group(root)} {reference_fasta} {fastq_pair[0]} {fastq_pair[1]} 2> /dev/null"
+	threads = Config.samtools_threads
+	if sort:
+		# bwa output has mates next to each other, which is all fixmate needs;
+		# -u (uncompressed) between the steps of the pipe
+		cmd  = f"set -o pipefail; {bwa_cmd} | {samtools} fixmate -m -u -@ {threads} - - 2> /dev/null "
+		cmd += f"| {samtools} sort -@ {threads} -m {Config.sort_memory} -T {bamfile}.tmp -O bam -o {bamfile} - 2> /dev/null"
+	else:
+		cmd = f"set -o pipefail; {bwa_cmd} | {samtools} view -b -@ {threads} -o {bamfile} - 2> /dev/null"
 	print(cmd)
-	subprocess.call(["bash", "-c", cmd])
-	# TODO: check output
+	if subprocess.call(["bash", "-c", cmd]) == 0: return True
+	if os.path.exists(bamfile): os.remove(bamfile)
+	return False
+
+
+def align_to_bam(bwa, samtools, reference_fasta, clean_fastq, alignments, root):
+	sort = Config.alignment_output == "sorted"
+	bamfile = f"{alignments}/{root}{alignment_suffixes[Config.alignment_output]}"
+	if not bwa_pipe(bwa, samtools, reference_fasta, clean_fastq[root], bamfile, sort, Config.bwa_threads, root):
+		print(f"alignment of {root} failed")
+		exit(1)
+	return bamfile
+
+
+def align_chunk(bwa, samtools, reference_fasta, chunk_files, chunk_bam, bwa_threads, root):
+	# the chunk is the unit of retry; the finished chunk bam appears under its name only when complete,
+	# so that a rerun after a failure skips the chunks already done
+	for attempt in range(1 + Config.alignment_retries):
+		if attempt: print(f"retrying {chunk_bam}, attempt {attempt+1}")
+		if bwa_pipe(bwa, samtools, reference_fasta, chunk_files, f"{chunk_bam}.part", True, bwa_threads, root):
+			os.rename(f"{chunk_bam}.part", chunk_bam)
+			for fastq in chunk_files: os.remove(fastq)
+			return True
+	return False
+
+
+def chunk_stamp(fastq_pair, chunk_pairs):
+	# the chunks of an earlier run can be reused only if they were cut from the same input, to the same size
+	stats = [os.stat(fastq) for fastq in fastq_pair]
+	return " ".join([f"{os.path.abspath(fastq)} {stat.st_size} {stat.st_mtime_ns}" for fastq, stat in zip(fastq_pair, stats)]
+					+ [str(chunk_pairs)])
+
+
+def chunk_directory(chunk_dir, stamp):
+	# the chunk directory, emptied if its chunks were made from something else
+	stamp_file = f"{chunk_dir}/stamp"
+	if os.path.exists(chunk_dir):
+		if os.path.exists(stamp_file) and open(stamp_file).read() == stamp: return
+		print(f"the chunks in {chunk_dir} are not from this input - removing them")
+		shutil.rmtree(chunk_dir)
+	os.mkdir(chunk_dir)
+	with open(stamp_file, "w") as outf: outf.write(stamp)
+
+
+def align_sharded(bwa, samtools, reference_fasta, clean_fastq, alignments, root):
+	# scatter: split the pair into chunks, and start aligning each chunk as soon as it is written
+	# gather: merge the sorted chunk bams into a single sorted bam
+	bamfile   = f"{alignments}/{root}.sort.bam"
+	chunk_dir = f"{alignments}/{root}_chunks"
+	chunk_directory(chunk_dir, chunk_stamp(clean_fastq[root], Config.alignment_chunk_pairs))
+	workers = max(1, Config.alignment_workers)
+	bwa_threads = max(1, Config.bwa_threads//workers)
+	# the splitting waits while all workers are busy, so that at most workers (+1 being written)
+	# chunks sit on the disk, rather than the whole input ahead of the alignment
+	in_flight = threading.BoundedSemaphore(workers)
+	chunk_bams = []
+	futures = []
+	with ThreadPoolExecutor(workers) as executor:
+		for [chunk, chunk_files] in split_pairs(clean_fastq[root], Config.alignment_chunk_pairs, f"{chunk_dir}/{root}"):
+			chunk_bam = f"{chunk_dir}/{root}.{chunk:04d}.sort.bam"
+			chunk_bams.append(chunk_bam)
+			if os.path.exists(chunk_bam):
+				print(f"found {chunk_bam}")
+				for fastq in chunk_files: os.remove(fastq)
+				continue
+			in_flight.acquire()
+			future = executor.submit(align_chunk, bwa, samtools, reference_fasta, chunk_files, chunk_bam, bwa_threads, root)
+			future.add_done_callback(lambda future: in_flight.release())
+			futures.append(future)
+		failed = len([future for future in futures if not future.result()])
+	if failed:
+		# the chunks that did get aligned are kept in the chunk directory, for the next run
+		print(f"alignment of {root}: {failed} chunk(s) failed")
+		exit(1)
+
+	cmd = f"{samtools} merge -f -@ {Config.samtools_threads} {bamfile} {' '.join(chunk_bams)} 2> /dev/null"
+	print(cmd)
+	if subprocess.call(["bash", "-c", cmd]) != 0:
+		print(f"merging the chunks of {root} failed")
+		if os.path.exists(bamfile): os.remove(bamfile)
+		exit(1)
+	shutil.rmtree(chunk_dir)
 	return bamfile
 
 
@@ -90,27 +201,40 @@ def main():
 	reference_fasta = Config.reference_fasta
 	dna_dir     = f"{home_path}/task_dna"
 	clean_dir   = f"{home_path}/clean_fastq"
-	rootnames   = Config.paired_reads_rootnames
+	rootnames   = get_rootnames()
 	read_labels = Config.read_labels
 	alnmts_dir  = f"{home_path}/alignments"
 
 	dependencies = [bwa, samtools, reference_fasta, dna_dir]
 	check_exist(dependencies)
-	check_reference_indexed(reference_fasta)  # e.g. hg19, was it indexed?
+	# e.g. hg19, was it indexed? from here on, we use the copy in the cache, with the indices next to it
+	reference_fasta = prepare_reference(reference_fasta, bwa, samtools)
 
 	# check whether we have trimmed files
 	clean_fastq = find_fastq(rootnames, read_labels, dna_dir, clean_dir)
 	if not os.path.exists(alnmts_dir): os.mkdir(alnmts_dir)
 
-	for root in rootnames:
-
-		# make good ol sam
-		samfile = align(bwa, reference_fasta, clean_fastq, alnmts_dir, root)
-
-		# convert sam to bam = compress
-		bamfile = sam2bam(samtools, samfile)
-		os.remove(samfile)
-
+	# with the index in the shared memory, bwa does not have to load it for each lane (or chunk)
+	shm_loaded = Config.bwa_shm and bwa_shm_load(bwa, reference_fasta)
+	try:
+		for root in rootnames:
+
+			if Config.alignment_output == "sharded":
+				align_sharded(bwa, samtools, reference_fasta, clean_fastq, alnmts_dir, root)
+				continue
+			if Config.alignment_output != "sam":
+				align_to_bam(bwa, samtools, reference_fasta, clean_fastq, alnmts_dir, root)
+				continue
+
+			# make good ol sam
+			samfile = align(bwa, reference_fasta, clean_fastq, alnmts_dir, root)
+
+			# convert sam to bam = compress
+			sam2bam(samtools, samfile)
+			os.remove(samfile)
+	finally:
+		# when run by the pipeline runner, the index stays for the other samples - the runner drops it at the end
+		if shm_loaded and not os.environ.get("SEQINSPECTOR_RUNNER"): bwa_shm_drop(bwa)
 
 	return
 
@@ -0,0 +1,93 @@
+#! /usr/bin/python3
+
+""" Merge the lanes of each sample into a single bam
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+The reads of a sample may come in several lanes (AH_S1_L001, AH_S1_L002, ...),
+which are trimmed and aligned separately, each lane as its own read
+group. Here they are put together, so that from the duplicate cleanup
+on the pipeline sees one bam per sample (AH_S1.bam, or AH_S1.sort.bam
+if the alignments were sorted already). Coordinate sorted lanes are
+merged by samtools merge; the unsorted ones are simply concatenated,
+with the read groups of all lanes in the header - the duplicate cleanup
+collates them anyway.
+
+Sources:
+http://www.htslib.org/doc/samtools-merge.html
+http://www.htslib.org/doc/samtools-cat.html
+
+This this script assumes the directory tree of the format
+.
+├── alignments
+├── clean_fastq
+├── fastqc
+├── python
+└── task_dna
+
+"""
+
+import subprocess
+
+from utils import *
+
+
+def merged_header(samtools, lane_bams, header_file):
+	# the header of the first lane, with the read groups of the others added
+	header = subprocess.check_output(["bash", "-c", f"{samtools} view -H {lane_bams[0]}"]).decode()
+	for bamfile in lane_bams[1:]:
+		other = subprocess.check_output(["bash", "-c", f"{samtools} view -H {bamfile}"]).decode()
+		header += "".join([line + "\n" for line in other.splitlines() if line.startswith("@RG")])
+	with open(header_file, "w") as outf:
+		outf.write(header)
+
+
+def merge_lanes(samtools, alnmts_dir, sample, lanes):
+	suffix = alignment_suffixes[Config.alignment_output]
+	lane_bams = [f"{alnmts_dir}/{lane}{suffix}" for lane in lanes]
+	check_exist(lane_bams)
+	bamfile = f"{alnmts_dir}/{sample}{suffix}"
+	if suffix.endswith(".sort.bam"):
+		cmd = f"{samtools} merge -f -@ {Config.samtools_threads} {bamfile} {' '.join(lane_bams)} 2> /dev/null"
+	else:
+		header_file = f"{alnmts_dir}/{sample}.header.sam"
+		merged_header(samtools, lane_bams, header_file)
+		cmd = f"{samtools} cat -h {header_file} -o {bamfile} {' '.join(lane_bams)} 2> /dev/null"
+	print(cmd)
+	retcode = subprocess.call(["bash", "-c", cmd])
+	if not suffix.endswith(".sort.bam"): os.remove(header_file)
+	if retcode != 0:
+		print(f"merging the lanes of {sample} failed")
+		if os.path.exists(bamfile): os.remove(bamfile)
+		exit(1)
+	return bamfile
+
+
+def main():
+
+	home_path = get_home_path()
+
+	samtools   = Config.samtools
+	alnmts_dir = f"{home_path}/alignments"
+	samples    = get_samples()
+
+	check_exist([samtools, alnmts_dir])
+
+	for sample in samples:
+		lanes = sample_lanes(sample)
+		if not lanes:
+			print(f"no lanes for {sample} in Config.paired_reads_rootnames")
+			exit(1)
+		if lanes == [sample]:
+			# the rootname has no lane in it - the alignment is already the sample bam
+			print(f"{sample}: nothing to merge")
+			continue
+		print(f"{sample}: merging {lanes}")
+		merge_lanes(samtools, alnmts_dir, sample, lanes)
+
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -11,6 +11,11 @@ http://www.htslib.org/doc/samtools-markdup.html
 2) fixmate
 3) sort (in position order)
 4) mark duplicates (confusingly, this also removes PCR duplicates)
+If 05_alignment.py was run with Config.alignment_output = "sorted", the
+first three were already done in the alignment pipe, and only the
+duplicates are marked here. With Config.dedup_mode = "streaming" the
+steps are connected by pipes, passing uncompressed bam between them,
+rather than each writing its own bam to the disk.
 
 Sources:
 http://www.htslib.org/doc/samtools.html
@@ -35,10 +40,11 @@ from fastqc import *
 def get_bamfiles(alnmts_dir, rootnames):
 	bamfiles = []
 	for rootnm in rootnames:
-		bamfile = f"{alnmts_dir}/{rootnm}.bam"
+		# 05_alignment.py might have produced the bam already fixmate-d and sorted
+		bamfile = f"{alnmts_dir}/{rootnm}{alignment_suffixes[Config.alignment_output]}"
 		if not os.path.exists(bamfile):
-			print(f"{rootnm}.bam not found in {alnmts_dir}")
-			exit()
+			print(f"{os.path.basename(bamfile)} not found in {alnmts_dir}")
+			exit(1)
 		bamfiles.append(bamfile)
 	return bamfiles
 
@@ -46,10 +52,8 @@ def get_bamfiles(alnmts_dir, rootnames):
 def collate(samtools, bamfile):
 	colltfile = bamfile[:-3] + "collt.bam"
 	# the flag -n here indicates sorting by name
-	cmd = f"{samtools} collate  -o {colltfile} {bamfile}   2> /dev/null"
-	print(cmd)
-	subprocess.call(["bash", "-c", cmd])
-	# TODO: check output
+	cmd = f"{samtools} collate -@ {Config.samtools_threads} -o {colltfile} {bamfile}   2> /dev/null"
+	run_or_exit(cmd, f"collating {bamfile} failed", [colltfile])
 	return colltfile
 
 
@@ -58,38 +62,54 @@ def fixmate(samtools, colltfile):
 	fixmate_bamfile = colltfile[:-len(old_extension)] + "fixmate.bam"
 	# -m flag is needed if the output is to be used in markdup
 	# note that this one for a change does not use -o option
-	cmd = f"{samtools} fixmate -m  {colltfile} {fixmate_bamfile}  2> /dev/null"
-	print(cmd)
-	subprocess.call(["bash", "-c", cmd])
-	# TODO: check output
+	cmd = f"{samtools} fixmate -m -@ {Config.samtools_threads} {colltfile} {fixmate_bamfile}  2> /dev/null"
+	run_or_exit(cmd, f"fixmate on {colltfile} failed", [fixmate_bamfile])
 	return fixmate_bamfile
 
 
 def coordinate_sort(samtools, fixmate_bamfile):
 	old_extension = "fixmate.bam"
 	sortfile = fixmate_bamfile[:-len(old_extension)] + "sort.bam"
-	cmd = f"{samtools} sort  -o {sortfile} {fixmate_bamfile}   2> /dev/null"
-	print(cmd)
-	subprocess.call(["bash", "-c", cmd])
-	# TODO: check output
+	cmd = f"{samtools} sort -@ {Config.samtools_threads} -m {Config.sort_memory} -o {sortfile} {fixmate_bamfile}   2> /dev/null"
+	run_or_exit(cmd, f"sorting {fixmate_bamfile} failed", [sortfile])
 	return sortfile
 
 
 def markdup(samtools, sortfile):
 	old_extension = "sort.bam"
 	dedup_bamfile = sortfile[:-len(old_extension)] + "dedup.bam"
-	cmd = f"{samtools} markdup {sortfile}  {dedup_bamfile}    2> /dev/null"
-	print(cmd)
-	subprocess.call(["bash", "-c", cmd])
-	# TODO: check output
+	cmd = f"{samtools} markdup -@ {Config.samtools_threads} {sortfile}  {dedup_bamfile}    2> /dev/null"
+	run_or_exit(cmd, f"marking the duplicates in {sortfile} failed", [dedup_bamfile])
 	return dedup_bamfile
 
 
 def index(samtools, dedupfile):
-	cmd = f"{samtools} index {dedupfile}   2> /dev/null"
+	cmd = f"{samtools} index -@ {Config.samtools_threads} {dedupfile}   2> /dev/null"
+	run_or_exit(cmd, f"indexing {dedupfile} failed", [f"{dedupfile}.bai"])
+
+
+def dedup_stream(samtools, bamfile):
+	# the same steps, connected by pipes; -u: the bam passed between them is not compressed
+	# (the sorted bam from 05_alignment.py needs only markdup)
+	prefix  = bamfile[:-len(".sort.bam")] if bamfile.endswith(".sort.bam") else bamfile[:-len(".bam")]
+	dedup_bamfile = f"{prefix}.dedup.bam"
+	threads = Config.samtools_threads
+	cmd = "set -o pipefail; "
+	if not bamfile.endswith(".sort.bam"):
+		# collate -O writes to stdout; the prefix is for its temporary files, as is -T for sort's
+		cmd += f"{samtools} collate -u -O -@ {threads} {bamfile} {prefix}.collate_tmp 2> /dev/null "
+		cmd += f"| {samtools} fixmate -m -u -@ {threads} - - 2> /dev/null "
+		cmd += f"| {samtools} sort -u -@ {threads} -m {Config.sort_memory} -T {prefix}.sort_tmp - 2> /dev/null | "
+		source = "-"
+	else:
+		source = bamfile
+	cmd += f"{samtools} markdup -@ {threads} {source} {dedup_bamfile} 2> /dev/null"
 	print(cmd)
-	# TODO: check output
-	subprocess.call(["bash", "-c", cmd])
+	if subprocess.call(["bash", "-c", cmd]) != 0:
+		print(f"duplicate cleanup for {bamfile} failed")
+		if os.path.exists(dedup_bamfile): os.remove(dedup_bamfile)
+		exit(1)
+	return dedup_bamfile
 
 
 def main():
@@ -98,7 +118,7 @@ def main():
 
 	samtools   = Config.samtools
 	alnmts_dir = f"{home_path}/alignments"
-	rootnames  = Config.paired_reads_rootnames
+	rootnames  = get_samples()  # the lanes are merged by now
 
 	check_exist([samtools, alnmts_dir])
 
@@ -108,13 +128,18 @@ def main():
 	print("bamfiles:", bamfiles)
 	for bamfile in bamfiles:
 		print()
+		if Config.dedup_mode == "streaming":
+			index(samtools, dedup_stream(samtools, bamfile))
+			continue
 		# pipeline:
 		prev_file = bamfile
-		for step in [collate, fixmate, coordinate_sort, markdup, index]:
+		steps = [collate, fixmate, coordinate_sort, markdup, index]
+		if bamfile.endswith(".sort.bam"): steps = [markdup, index]
+		for step in steps:
 			print(step.__name__)
 			new_file  = step(samtools, prev_file)
 			# leave the orignal bam for now; the last step is indexing which does not change the penultimate ba,
-			if step.__name__ not in ["collate", "index"]:  os.remove(prev_file)
+			if prev_file != bamfile and step.__name__ != "index":  os.remove(prev_file)
 			prev_file = new_file
 
 
@@ -23,6 +23,7 @@ format of input/outpud used on raw and trimmed seqeunces.
 
 """
 
+import shutil
 # setting home path, checing deps, importing config too
 # from utils import *
 # fastq-specific functions - imports utils
@@ -35,13 +36,13 @@ def main():
 
 	samtools        = Config.samtools
 	fastqc          = Config.fastqc
-	unzip           = Config.unzip
 	alignments      = f"{home_path}/alignments"
 	fastqc_this_dir = f"{home_path}/fastqc/dedup"  # the output in this round
-	scratch         = f"{home_path}/scratch"
 
-	rootnames   = Config.paired_reads_rootnames
+	rootnames   = get_samples()  # the lanes are merged by now
 	read_labels = Config.read_labels
+	# the runner may check several samples at the same time - each run gets its own scratch
+	scratch     = f"{home_path}/scratch_{'_'.join(rootnames)}"
 	dedup_bams  = [f"{alignments}/{r}.dedup.bam" for r in rootnames]
 
 	check_exist([samtools, alignments] + dedup_bams)
@@ -53,10 +54,10 @@ def main():
 		cmd  = f"{samtools} fastq  "
 		cmd += f"-1 {scratch}/{rootname}_{read_labels[0]}.fastq -2 {scratch}/{rootname}_{read_labels[1]}.fastq "
 		cmd += f"-0 /dev/null -s /dev/null  -n  {alignments}/{rootname}.dedup.bam"
-		print(cmd)
-		subprocess.call(["bash", "-c", cmd])
+		run_or_exit(cmd, f"extracting the reads from {rootname}.dedup.bam failed",
+					[f"{scratch}/{rootname}_{label}.fastq" for label in read_labels])
 
-	dependencies = [fastqc, unzip, scratch, fastqc_this_dir]
+	dependencies = [fastqc, scratch, fastqc_this_dir]
 	run_fastqc(dependencies, rootnames, read_labels)
 	talk_fastqc(rootnames, read_labels, fastqc_this_dir)
 	# for the report
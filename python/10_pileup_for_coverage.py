@@ -6,7 +6,9 @@ Part of seqinspector toy NGS QC pipeline
 Ivana Mihalek,  2020
 
 This script will produce pielup output, while the following script,
-11_depth_and_coverage.py, will actually crunch the numbers. The target
+11_depth_and_coverage.py, will actually crunch the numbers. (With
+Config.coverage_engine = "depth", the numbers are crunched here already,
+in a single samtools depth pass, into pileup/coverage/coverage_summary.tsv.) The target
 regions for the two sets are merged if overlaping, in the attempt
 to provide compact comparison.
 
@@ -30,43 +32,23 @@ with the original task folder). This script will add directory called
 
 import matplotlib.pyplot as plt
 from pileup import *
+from intervals import *
 
 # fastq-specific functions - imports utils
 from fastqc import *
 
 
-def add_interval(regions, new_interval):
-	place_found = False
-	for i in range(len(regions)):
-		interval = regions[i]
-		if new_interval[1]<interval[0]:
-			# insert at i
-			regions.insert(i, new_interval)
-			place_found = True
-			break
-		elif new_interval[0]<=interval[1]:
-			# merge
-			regions[i] = [min(new_interval[0], interval[0]), max(new_interval[1], interval[1])]
-			place_found = True
-			break
-	# append
-	if not place_found: regions.append(new_interval)
-
-
-def find_place(regions, qry, sanity_check=False):
-	target_interval = None
-	for interval in regions:
-		if interval[0]<=qry[0] and qry[1]<=interval[1]:
-			if sanity_check:
-				if interval[0]< qry[0] or qry[1] < interval[1]:
-					print(f"{qry}  belongs to {interval}")
-				else:
-					print(f"{qry} is equal to {interval}")
-			target_interval = interval
-			break
+def find_place(index, qry, sanity_check=False):
+	# index: IntervalIndex of the merged regions on the chromosome
+	target_interval = index.containing(qry[0], qry[1])
 	if not target_interval:
 		print(f"bug in interval manipulation: place not found for {qry}")
-		exit()
+		exit(1)
+	if sanity_check:
+		if target_interval[0]< qry[0] or qry[1] < target_interval[1]:
+			print(f"{qry}  belongs to {target_interval}")
+		else:
+			print(f"{qry} is equal to {target_interval}")
 	return target_interval
 
 
@@ -78,7 +60,6 @@ def int_cast(x, fnm):
 
 
 def regions_merge(region_fnms, sanity_check=False):
-	merged_regions = {}
 	regions = {}
 	for regionfnm in region_fnms:
 		regions[regionfnm] = {}
@@ -88,21 +69,27 @@ def regions_merge(region_fnms, sanity_check=False):
 			fields = line.strip().split()[:3]
 			if len(fields) < 3: continue
 			[chrom, start, end]  = [int_cast(field, regionfnm) for field in fields]
-			if chrom not in merged_regions: merged_regions[chrom] = []
-			add_interval(merged_regions[chrom], [start, end])
 			if chrom not in regions[regionfnm]: regions[regionfnm][chrom] = []
 			regions[regionfnm][chrom].append([start, end])
 		inf.close()
 
+	# sort and sweep, chromosome by chromosome (see intervals.py)
+	chroms = set([chrom for regionfnm in region_fnms for chrom in regions[regionfnm]])
+	merged_regions = {}
+	for chrom in chroms:
+		merged_regions[chrom] = merge_intervals([intv for regionfnm in region_fnms
+												for intv in regions[regionfnm].get(chrom, [])])
+
 	if sanity_check:
 		print(f"number of merged regions: {sum([len(v) for v in merged_regions.values()])}")
+		index = {chrom: IntervalIndex(intervals, intervals) for chrom, intervals in merged_regions.items()}
 		for regionfnm in region_fnms:
 			# print(regionfnm)
 			for chrom, intervals in regions[regionfnm].items():
 				# print("\t", chrom)
 				for intv in intervals:
 					# will exit on failure
-					find_place(merged_regions[chrom], intv, sanity_check=False)
+					find_place(index[chrom], intv, sanity_check=False)
 
 	return merged_regions
 
@@ -121,9 +108,9 @@ def main():
 	samtools    = Config.samtools
 	alnmts_dir  = f"{home_path}/alignments"
 	dna_dir     = f"{home_path}/task_dna"
-	rootnames   = Config.paired_reads_rootnames
+	rootnames   = get_samples()  # the lanes are merged by now
 	bamfiles    = [f"{alnmts_dir}/{rootnm}.dedup.bam" for rootnm in rootnames]
-	region_fnms = [f"{dna_dir}/{rootnm.replace('L001','target')}.txt" for rootnm in rootnames]
+	region_fnms = [target_file(dna_dir, rootnm) for rootnm in rootnames]
 	check_exist([samtools, alnmts_dir, dna_dir] + bamfiles + region_fnms)
 
 	merged_regions = regions_merge(region_fnms, sanity_check=False)
@@ -134,8 +121,13 @@ def main():
 	# output the merged regions for input in IGV
 	output_merged_regions(pileup_dir, merged_regions)
 
-	# run samtools pileup on each of the regions
-	output_pileup_cvg(pileup_dir, samtools, merged_regions, bamfiles)
+	clear_coverage_output(pileup_dir)
+	if Config.coverage_engine == "depth":
+		# a single pass over the bam files, summarized per region (see pileup.py)
+		output_coverage_depth(pileup_dir, samtools, merged_regions, bamfiles)
+	else:
+		# run samtools pileup on each of the regions
+		output_pileup_cvg(pileup_dir, samtools, merged_regions, bamfiles)
 
 	return
 
@@ -7,7 +7,8 @@ Ivana Mihalek,  2020
 
 Calculate depth and coverage for the pileup files generated in the
 previous script, 10_pileup_for_coverage.py, and create figure
-for the report.
+for the report: for two samples, the depths of one against the other,
+for more, a heatmap of the depth in each region for each sample.
 
 Sources:
 http://www.htslib.org/doc/samtools-mpileup.html
@@ -28,39 +29,27 @@ with the original task folder). Other dependencies shoud be set in config.py.
 """
 
 import matplotlib.pyplot as plt
+import numpy as np
+
 from pileup import *
 
 # fastq-specific functions - imports utils
 from fastqc import *
 
 
-def make_graph(coverage, avg_depth):
-	number_of_regions = sum([len(v) for v in coverage.values()])
-	height = [[], []]  # we will set the bar height to be proportional to the sequencing depth in each region
-	alpha  = [[], []]  # and transparency to the coverage of the region
-	for chrom in sorted(coverage.keys()):
-		for start in sorted(coverage[chrom].keys()):
-			for i in range(2):
-				dpth = avg_depth[chrom][start][i]
-				bar_height = dpth  # max(dpth, 0.1), no need, matplotlib know how to handle 0s on the log scale
-				height[i].append(bar_height*(-1)**(1-i))  # invert the first set of depths (correspoding to 'AH' set)
-				# alpha[i].append(1-coverage[chrom][start][i])
-				alpha[i].append(0.5 if coverage[chrom][start][i]<0.3 else 1)
-
-	# sort by height in the first set which I happen to know has more points
-	sorted_height = [[], []]
-	idx = range(number_of_regions)
-	sorted_idx = sorted(idx, key=lambda i: height[1][i], reverse=True)
-	sorted_height[0] = [height[0][i] for i in sorted_idx]
-	sorted_height[1] = [height[1][i] for i in sorted_idx]
+def mirrored_bars(stats):
+	# two samples: the bar height proportional to the sequencing depth in each region,
+	# and the transparency to the coverage of the region; the first sample upside down
+	depth = stats.avg_depth
+	# sort by depth in the second set which I happen to know has more points
+	order = np.argsort(-depth[:, 1], kind="stable")
+	idx = range(len(stats))
 
 	fig, ax = plt.subplots()
-
-	color = [(0.0, 0.0, 1.0, a) for a in alpha[0]]  # blue with alpha inverse prop to coverage
-	ax.bar(idx, sorted_height[0], color=color, label="AH")
-
-	color = [(1.0, 0.0, 0.0, a) for a in alpha[0]]  # red with alpha inverse prop to coverage
-	ax.bar(idx, sorted_height[1], color=color, label="CH")
+	for [i, rgb] in [[0, (0.0, 0.0, 1.0)], [1, (1.0, 0.0, 0.0)]]:  # blue and red
+		alpha = np.where(stats.coverage[order, i] < 0.3, 0.5, 1)
+		# no need for max(dpth, 0.1), matplotlib know how to handle 0s on the log scale
+		ax.bar(idx, depth[order, i]*(-1)**(1-i), color=[rgb + (a,) for a in alpha.tolist()], label=stats.samples[i])
 
 	# tickamrs: logarithmic and positive
 	plt.yscale("symlog")  # symmetric log scale (log in negative direction) - do before tkaing abs value of ticks
@@ -68,7 +57,7 @@ def make_graph(coverage, avg_depth):
 	ax.set_yticklabels([int(abs(tick)) for tick in ticks])  # the lower part of the graph is not really negative
 
 	# axis labels
-	plt.xlabel('regions, sorted by depth in the CH set', fontsize=16)
+	plt.xlabel(f'regions, sorted by depth in the {stats.samples[1]} set', fontsize=16)
 	plt.ylabel('depth', fontsize=16)
 
 	# legend
@@ -77,6 +66,26 @@ def make_graph(coverage, avg_depth):
 	fig.tight_layout()  # adjusts the padding between and around subplots.
 
 
+def depth_heatmap(stats):
+	# any number of samples: a column for each sample, a row for each region,
+	# the regions sorted by their median depth across the samples
+	order = np.argsort(-np.median(stats.avg_depth, axis=1), kind="stable")
+	fig, ax = plt.subplots()
+	image = ax.imshow(np.log10(1 + stats.avg_depth[order]), aspect="auto", interpolation="nearest")
+	fig.colorbar(image, ax=ax, label="log10(1 + depth)")
+	if len(stats.samples) <= 24:
+		ax.set_xticks(range(len(stats.samples)))
+		ax.set_xticklabels(stats.samples, rotation=90)
+	plt.xlabel('samples', fontsize=16)
+	plt.ylabel('regions, sorted by median depth', fontsize=16)
+	fig.tight_layout()
+
+
+def make_graph(stats):
+	if len(stats.samples) == 2:
+		mirrored_bars(stats)
+	else:
+		depth_heatmap(stats)
 	plt.show()
 
 
@@ -88,16 +97,16 @@ def main():
 	alnmts_dir  = f"{home_path}/alignments"
 	cvg_dir     = f"{home_path}/pileup/coverage"
 	dna_dir     = f"{home_path}/task_dna"
-	rootnames   = Config.paired_reads_rootnames
+	rootnames   = get_samples()  # the lanes are merged by now
 	bamfiles    = [f"{alnmts_dir}/{rootnm}.dedup.bam" for rootnm in rootnames]
-	region_fnms = [f"{dna_dir}/{rootnm.replace('L001','target')}.txt" for rootnm in rootnames]
+	region_fnms = [target_file(dna_dir, rootnm) for rootnm in rootnames]
 	check_exist([samtools, alnmts_dir, dna_dir, cvg_dir] + bamfiles + region_fnms)
 
-	# summarize coverage/depth for each region
-	[coverage, avg_depth] = summarize_coverage_pileup(cvg_dir)[:2]
+	# summarize coverage/depth for each region, (regions x samples)
+	stats = summarize_coverage_pileup(cvg_dir, rootnames)
 
-	# visual summary of depth and coverage for the two samples
-	make_graph(coverage, avg_depth)
+	# visual summary of depth and coverage for the samples
+	make_graph(stats)
 
 	return
 
@@ -8,7 +8,9 @@ Ivana Mihalek,  2020
 Outputs pileup (different then the pileup files used to calculate
 coverage; the unortunate nomenclature is not mine) to investigate
 if any variants can be called. The laater is particularly problematic
-in the case of the AH set.
+in the case of the AH set. The variants are called only within the
+merged target regions (pileup/coverage/merged_target_regions.bed, from
+10_pileup_for_coverage.py), in parallel shards (see pileup.py).
 
 Sources:
 https://samtools.github.io/bcftools/howtos/variant-calling.html
@@ -30,20 +32,12 @@ with the original task folder). This script will add directory called
 
 import matplotlib.pyplot as plt
 from pileup import *
+from reference import *
 
 # fastq-specific functions - imports utils
 from fastqc import *
 
 
-def bcf_index(samtools, ref_genome):
-	if not os.path.exists(f"{ref_genome}.fai"):
-		cmd = f"{samtools}  faidx  {ref_genome} 2> /dev/null"
-		print(cmd)
-		subprocess.call(["bash", "-c", cmd])
-	else:
-		print(f"found {ref_genome}.fai")
-
-
 def main():
 
 	home_path = get_home_path()
@@ -53,9 +47,11 @@ def main():
 	ref_genome  = Config.reference_fasta
 	alnmts_dir  = f"{home_path}/alignments"
 	dna_dir     = f"{home_path}/task_dna"
-	rootnames   = Config.paired_reads_rootnames
+	rootnames   = get_samples()  # the lanes are merged by now
 	bamfiles    = [f"{alnmts_dir}/{rootnm}.dedup.bam" for rootnm in rootnames]
-	region_fnms = [f"{dna_dir}/{rootnm.replace('L001','target')}.txt" for rootnm in rootnames]
+	region_fnms = [target_file(dna_dir, rootnm) for rootnm in rootnames]
+	# the regions merged over all samples (by 10_pileup_for_coverage.py)
+	merged_regions_fnm = f"{home_path}/pileup/coverage/merged_target_regions.bed"
 	check_exist([samtools, bcftools, alnmts_dir, dna_dir] + bamfiles + region_fnms)
 
 	pileup_dir = f"{home_path}/pileup/variants"
@@ -63,10 +59,14 @@ def main():
 
 	# bcftools wants reference file as an input, with its own indexing (faidx)
 	# which is, of course, produced by samtools
-	bcf_index(samtools, ref_genome)
+	ref_genome = prepare_reference(ref_genome)
 
 	# run bcftools pileup on each of the regions
-	output_pileup_vcf(bcftools, ref_genome, pileup_dir, bamfiles)
+	if Config.variant_shards:
+		check_exist([merged_regions_fnm])
+		output_pileup_vcf(bcftools, ref_genome, pileup_dir, bamfiles, read_regions(merged_regions_fnm))
+	else:
+		output_pileup_vcf(bcftools, ref_genome, pileup_dir, bamfiles)
 
 	return
 
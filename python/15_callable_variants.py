@@ -24,8 +24,15 @@ This this script assumes the directory tree of the format
 
 where task_dna contains the fastq files (the name chosen to correspond
 with the original task folder).  Other dependencies shoud be set in config.py.
+
+Each vcf is read once, and the calls are assigned to the regions by
+bisection (see pileup.py), rather than running bcftools view for each
+region. The vcfs of the samples are read in parallel, and the output
+table has a column with the number of calls for each sample.
 """
 
+from multiprocessing import Pool
+
 import matplotlib.pyplot as plt
 from pileup import *
 
@@ -33,72 +40,69 @@ from pileup import *
 from fastqc import *
 
 
-def read_regions(merged_regions_fnm):
-	regions = {}
-	inf = open(merged_regions_fnm)
-	for line in inf:
-		fields = line.strip().split()[:3]
-		if len(fields) < 3: continue
-		[chrom, start, end]  = [int_cast(field.replace("chr",""), merged_regions_fnm) for field in fields]
-		if chrom not in regions: regions[chrom] = []
-		regions[chrom].append([start, end])
-	inf.close()
-	return regions
+def region_rows(regions):
+	# [chrom, start, end] for each region, in the order of the output table
+	return [[chrom, start, end] for chrom in sorted(regions.keys()) for [start, end] in regions[chrom]]
+
+
+def sample_calls(vcf_and_regions):
+	# the number of calls in each region, for one sample (in a worker process)
+	[vcf_file, regions] = vcf_and_regions
+	row_of = {(chrom, start): r for r, [chrom, start, end] in enumerate(region_rows(regions))}
+	calls = np.zeros(len(row_of), dtype=np.int64)
+	for chrom, calls_in_region in summarize_variant_pileup(vcf_file, regions).items():
+		for start, phred_likelihoods in calls_in_region.items():
+			calls[row_of[(chrom, start)]] = len(phred_likelihoods)
+	return calls
+
 
+def count_calls(vcf_files, regions):
+	# (regions x samples) numbers of calls; each vcf is read in its own process
+	with Pool(max(1, min(Config.variant_workers, len(vcf_files)))) as pool:
+		calls = pool.map(sample_calls, [[vcf_file, regions] for vcf_file in vcf_files])
+	return np.column_stack(calls) if calls else np.zeros((len(region_rows(regions)), 0), dtype=np.int64)
 
-def talk(regions, phred_likelihoods):
-	for chrom in range(1,23): # I don have sex chroms in this toy problem
-		if chrom not in regions: continue
-		print("chrom", chrom)
-		for [start, end] in regions[chrom]:
-			calls_count = [0, 0]
-			for i in range(2):
-				if not chrom in phred_likelihoods[i]: continue
-				if not start in phred_likelihoods[i][chrom]: continue
-				calls_count[i] = len(phred_likelihoods[i][chrom][start])
 
-				print(f"\t {start}     {calls_count}  ")
+def talk(regions, samples, calls):
+	chrom = None
+	for r, [region_chrom, start, end] in enumerate(region_rows(regions)):
+		if region_chrom != chrom:
+			chrom = region_chrom
+			print("chrom", chrom)
+		if calls[r].any(): print(f"\t {start}     {dict(zip(samples, calls[r].tolist()))}  ")
 
 
-def write(vcf_dir, regions, phred_likelihoods):
+def write(vcf_dir, regions, samples, calls):
 	with open(f"{vcf_dir}/calls_per_interval.tsv", "w") as outf:
-		for chrom in range(1,23): # I don have sex chroms in this toy problem
-			if chrom not in regions: continue
-			for [start, end] in regions[chrom]:
-				calls_count = [0, 0]
-				for i in range(2):
-					if not chrom in phred_likelihoods[i]: continue
-					if not start in phred_likelihoods[i][chrom]: continue
-					calls_count[i] = len(phred_likelihoods[i][chrom][start])
-				print(f"{chrom}\t{start}\t{calls_count[0]}\t{calls_count[1]}", file=outf)
+		print("\t".join(["#chrom", "start", "end"] + samples), file=outf)
+		for [[chrom, start, end], counts] in zip(region_rows(regions), calls.tolist()):
+			print("\t".join([str(x) for x in [chrom, start, end] + counts]), file=outf)
 
 
 def main():
 
 	home_path = get_home_path()
 
-	bcftools    = Config.bcftools
 	alnmts_dir  = f"{home_path}/alignments"
 	cvg_dir     = f"{home_path}/pileup/coverage"
 	vcf_dir     = f"{home_path}/pileup/variants"
 	dna_dir     = f"{home_path}/task_dna"
-	rootnames   = Config.paired_reads_rootnames
+	rootnames   = get_samples()  # the lanes are merged by now
 	merged_regions_fnm = f"{cvg_dir}/merged_target_regions.bed"
 
 	vcf_files   = [f"{vcf_dir}/{rootnm}.dedup.vcf.gz" for rootnm in rootnames]
-	check_exist([bcftools, alnmts_dir, dna_dir, vcf_dir, cvg_dir, merged_regions_fnm] + vcf_files)
+	check_exist([alnmts_dir, dna_dir, vcf_dir, cvg_dir, merged_regions_fnm] + vcf_files)
 
 	regions = read_regions(merged_regions_fnm)
 
-	# summarize coverage/depth for each region
-	phred_likelihoods = []
-	for i in range(2):
-		phred_likelihoods.append(summarize_variant_pileup(bcftools, vcf_files[i], regions))
+	# the number of calls in each region, for each sample
+	calls = count_calls(vcf_files, regions)
 
-	talk(regions, phred_likelihoods)
+	# (for a cohort, the per-region listing would be too long to read)
+	if len(rootnames) <= 8: talk(regions, rootnames, calls)
 
-	# let's write this out because it is rather slow - we'll use the info in the xlsx table
-	write(vcf_dir, regions, phred_likelihoods)
+	# we'll use the info in the xlsx table
+	write(vcf_dir, regions, rootnames, calls)
 
 	return
 
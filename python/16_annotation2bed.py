@@ -0,0 +1,56 @@
+#! /usr/bin/python3
+
+""" Annotate the target regions by the genes they cover
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+The features of the gene annotation (Config.annotation_gtf, in the
+annotation directory; can be gzipped) are intersected with the merged
+target regions, and the result written to
+annotation/target_regions_annotated.bed, as well as to a binary index
+(target_regions_annotated.npz) read by the gene annotation and the
+excel stages. The GTF is parsed only the first time (and when it or
+Config.annotation_features change) - see annotation.py.
+
+This this script assumes the directory tree of the format
+.
+├── alignments
+├── annotation
+├── clean_fastq
+├── fastqc
+├── pileup
+├── python
+└── task_dna
+
+Other dependencies shoud be set in config.py.
+"""
+
+from pileup import *
+from utils import *
+from annotation import *
+
+
+def main():
+
+	home_path = get_home_path()
+
+	cvg_dir        = f"{home_path}/pileup/coverage"
+	annotation_dir = f"{home_path}/annotation"
+	gtf_file       = f"{annotation_dir}/{Config.annotation_gtf}"
+	merged_regions_fnm = f"{cvg_dir}/merged_target_regions.bed"
+	annotated_bed  = f"{annotation_dir}/target_regions_annotated.bed"
+	check_exist([annotation_dir, gtf_file, merged_regions_fnm])
+
+	table    = gtf_features(gtf_file, Config.annotation_features, f"{gtf_file}.features.npz")
+	overlaps = intersect(table, read_regions(merged_regions_fnm))
+	print(f"{len(overlaps)} overlaps of {Config.annotation_features} with the target regions")
+
+	write_annotated_bed(annotated_bed, table, overlaps)
+	write_annotation_index(annotation_index_file(annotated_bed), table, overlaps)
+
+	return
+
+
+if __name__ == "__main__":
+	main()
@@ -21,12 +21,22 @@ with the original task folder). Other dependencies shoud be set in config.py.
 
 
 import matplotlib.pyplot as plt
+import numpy as np
 import xlsxwriter
 
 from pileup import *
 from utils import *
+from intervals import IntervalIndex
+from annotation import annotation_index_file, read_annotation_index
 from styling import Styling
 
+# the limits of a single sheet: the number of rows in Excel, and the number of links xlsxwriter can write
+xlsx_max_rows = 1048576
+xlsx_max_urls = 65530
+
+annot_not_found = "annot not found"
+unknown_gene = {"name": "", "uniprot": "", "expression": "", "disease": ""}
+
 
 class Annotation:
 	def __init__(self, region, gene):
@@ -35,23 +45,23 @@ class Annotation:
 		self.__region = region
 
 	def region(self):
+		# IntervalIndex of the annotated regions on the current chromosome, with the gene name for each
 		if self.chrom and self.chrom in self.__region:
 			return self.__region[self.chrom]
 		else:
-			return []
+			return IntervalIndex([])
 
+	def gene_info(self, gene_name):
+		# a gene that is not in the gene annotation file (or no gene at all) still gets a row
+		return self.gene.get(gene_name, unknown_gene)
 
-def read_region_annotation(ncbi_refseq):
-	annotation = {}
-	with open(ncbi_refseq) as inf:
-		for line in inf:
-			fields  = line.strip().split("\t")
-			if len(fields) != 4: continue  # not interested
-			[chrom, start, end, annotstr] = fields
-			chrom_number = int(chrom.replace("chr",""))
-			if chrom_number not in annotation: annotation[chrom_number] = {}
-			annotation[chrom_number][f"{start} {end}"] = annotstr
-	return annotation
+
+def read_region_annotation(annotation_index):
+	# the gene names come already pulled out of the GTF attributes, in the index made by 16_annotation2bed.py
+	region = {}
+	for chrom, [intervals, gene_names] in read_annotation_index(annotation_index).items():
+		region[chrom] = IntervalIndex(intervals, [gene_name if gene_name else annot_not_found for gene_name in gene_names])
+	return region
 
 
 def read_gene_annotation(gene_annot_file):
@@ -69,109 +79,122 @@ def read_annotation(ncbi_refseq, gene_annot_file):
 	return Annotation(read_region_annotation(ncbi_refseq), read_gene_annotation(gene_annot_file))
 
 
-def find_annotation(annotation, start, end):
-	for region, annotstr in annotation.region().items():
-		[annot_start, annot_end] = [int(i) for i in region.split()]
-		if annot_start<=start<=annot_end or annot_start<=end<=annot_end:
-			return annotstr
-	return "annot not found"
-
+def find_genes(annotation, starts, ends):
+	# for each of the regions, all genes overlapping it (each once, in the order of their annotated start)
+	genes = []
+	for overlapping in annotation.region().overlapping_batch(starts, ends):
+		genes.append(list(dict.fromkeys(overlapping)) if overlapping else [annot_not_found])
+	return genes
 
-def get_gene_name(annotation, start, end):
-	# paranoia to worry about two gene name fields in here?
-	annotation_string = find_annotation(annotation, start, end)
-	gene_name = list(filter(lambda field: "gene_name" in field, annotation_string.split(";")))[0]
-	return gene_name.strip().split()[1].replace("\"", "")
 
-
-def group_by_gene(stats, region_end, annotation):
-	# there are several statistics on this list, they shoul
-	# all have region start as their first argument
+def group_by_gene(stats, rows, annotation):
+	# the rows of stats (the regions on the current chromosome) for each gene;
+	# a region overlapping several genes is listed with each of them
 	gene = {}
-	for start in sorted(stats[0].keys()):
-		end = region_end[start]
-		gene_name = get_gene_name(annotation, start, end)
-		if gene_name not in gene: gene[gene_name] = []
-		gene[gene_name].append(f"[hg19] {start}-{end}")
+	starts = stats.start[rows].tolist()
+	ends   = stats.end[rows].tolist()
+	for r, gene_names in zip(rows, find_genes(annotation, starts, ends)):
+		for gene_name in gene_names:
+			if gene_name not in gene: gene[gene_name] = []
+			gene[gene_name].append(r)
 	return gene
 
 
-def write_datasets(worksheet, style, stats, region, row, column):
-	[coverage, avg_depth, calls_per_interval] = stats
-	rows_spanned = 0
-	# avg_depth is organized by region start, given as integer;
-	# regions ids a string of the format f"{assembly} {start}-{end}"
-	start = int(re.split(" |-", region)[1])
-	row_span = len(avg_depth[start])
-	if len(coverage[start]) != row_span:
-		print(f"mismatch in the number of datasets at pos: {start}")
-		exit()
+def needs_attention(stats, r):
+	# draw attention to the calls in a sample that fall in a region
+	# covered in that sample, but not covered in some other sample
+	depth = stats.avg_depth[r]
+	covered = depth > coverage_min_depth
+	return (stats.calls[r] > 0) & covered & (~covered).any()
+
+
+def write_datasets(worksheet, style, stats, r, row, column):
+	# the depth, the coverage and the number of calls in region r, each for all samples
 	# I think this is the most legible format for the table
-	for i in [1, 0]:
-		worksheet.write_string(row, column, "%.0f" % avg_depth[start][i])
+	for depth in stats.avg_depth[r].tolist():
+		worksheet.write_number(row, column, depth, style.xlsx_format["integer"])
+		column += 1
+	for coverage in stats.coverage[r].tolist():
+		worksheet.write_number(row, column, coverage, style.xlsx_format["fraction"])
 		column += 1
-	for i in [1, 0]:
-		worksheet.write_string(row, column, "%.2f" % coverage[start][i])
+	for [calls, attention] in zip(stats.calls[r].tolist(), needs_attention(stats, r).tolist()):
+		worksheet.write_number(row, column, calls, style.xlsx_format["red_border" if attention else "integer"])
 		column += 1
 
-	worksheet.write_string(row, column, "%d" % calls_per_interval[start][1])
-	column += 1
-
-	# draw attention to calls in AH that fall in regions not covered by CH
-	if calls_per_interval[start][0]>0 and avg_depth[start][0]>10 and avg_depth[start][0]>avg_depth[start][1]:
-		worksheet.write_string(row, column, "%d" % calls_per_interval[start][0], style.xlsx_format["red_border"])
-	else:
-		worksheet.write_string(row, column, "%d" % calls_per_interval[start][0])
-	rows_spanned += 1
-	return rows_spanned
-
-
-def write_region(worksheet, style, stats, regions, annotation, row, column):
-	# TODO which exon(s) does the region correspond to
-	rows_spanned = 0
-	for region in regions:
-		row_span = write_datasets(worksheet, style, stats, region, row, column+1)
-		if not row_span: continue
-		if row_span == 1:
-			worksheet.write_string(row, column, region)
-		else:
-			worksheet.merge_range(row, column, row+row_span-1, column, region)
-		row += row_span
-		rows_spanned += row_span
-	return rows_spanned
-
-
-def write_chromosome(worksheet, style, stats, region_end, annotation, row, column):
-	gene = group_by_gene(stats, region_end, annotation)
-	rows_spanned = 0
-	for gene_name, regions in gene.items():
-		row_span = write_region(worksheet, style, stats, regions, annotation, row, column+3)
-		if not row_span: continue
-		disease = annotation.gene[gene_name]["disease"]
-		uniprot = annotation.gene[gene_name]['uniprot']
+
+class Report:
+	# In constant_memory mode xlsxwriter writes each row out as soon as the next one is started,
+	# so the rows have to be written in order, and nothing can span several rows (no merged cells).
+	# Each chromosome gets its own sheet; if it does not fit, it continues on "chrN (2)" etc.
+	def __init__(self, workbook, style, samples):
+		self.workbook  = workbook
+		self.style     = style
+		self.samples   = samples
+		self.worksheet = None
+		self.chrom = None
+		self.part  = 0
+		self.row   = 0
+		self.urls  = 0
+
+	def new_sheet(self):
+		self.part += 1
+		name = f"chr{self.chrom}" if self.part == 1 else f"chr{self.chrom} ({self.part})"
+		self.worksheet = self.workbook.add_worksheet(name)
+		set_column_widths(self.worksheet, self.style)
+		write_header(self.worksheet, self.style, self.samples)
+		self.row  = 0
+		self.urls = 0
+
+	def start_chromosome(self, chrom):
+		# the sheet is added with the first row, so that a chromosome with nothing to report has none
+		self.chrom = chrom
+		self.part  = 0
+		self.worksheet = None
+
+	def next_row(self):
+		if self.worksheet is None or self.row + 1 >= xlsx_max_rows or self.urls >= xlsx_max_urls:
+			self.new_sheet()
+		self.row += 1
+		return self.row
+
+	def write_url(self, row, column, url, string):
+		self.worksheet.write_url(row, column, url, string=string)
+		self.urls += 1
+
+
+def write_chromosome(report, stats, annotation):
+	# one row per region, with its chromosome and gene repeated on each row
+	# (so the table can be sorted and filtered)
+	gene = group_by_gene(stats, stats.chromosome(annotation.chrom), annotation)
+	for gene_name, rows in gene.items():
+		disease = annotation.gene_info(gene_name)["disease"]
+		uniprot = annotation.gene_info(gene_name)['uniprot']
 		uniprot_hyperlink = f"https://www.uniprot.org/uniprot/{uniprot}"
-		if row_span == 1:
-			worksheet.write_string(row, column, gene_name)
-			worksheet.write_url(row, column+1, uniprot_hyperlink, string=uniprot)
-			worksheet.write_string(row, column+2, disease)
-		else:  # merge range cannot have range of 1 (duh ...)
-			worksheet.merge_range(row, column, row+row_span-1, column, gene_name)
-			worksheet.merge_range(row, column+1, row+row_span-1, column+1, "", style.xlsx_format["hyperlink"])
-			worksheet.write_url(row, column+1, uniprot_hyperlink, string=uniprot)
-			worksheet.merge_range(row, column+2, row+row_span-1, column+2, disease)
-		row += row_span
-		rows_spanned += row_span
-	return rows_spanned
-
-
-def read_calls_per_interval(calls_file):
-	calls_per_interval = {}
+		for r in rows:
+			row = report.next_row()
+			worksheet = report.worksheet
+			worksheet.write_string(row, 0, f"chr{annotation.chrom}")
+			worksheet.write_string(row, 1, gene_name)
+			if uniprot:
+				report.write_url(row, 2, uniprot_hyperlink, uniprot)
+			else:
+				worksheet.write_string(row, 2, uniprot)
+			worksheet.write_string(row, 3, disease)
+			worksheet.write_string(row, 4, f"[hg19] {stats.start[r]}-{stats.end[r]}")
+			write_datasets(worksheet, report.style, stats, r, row, 5)
+
+
+def read_calls_per_interval(calls_file, stats):
+	# the numbers of calls, a column for each sample, into stats.calls
 	with open(calls_file) as inf:
-		for line in inf:
-			[chrom, start, count1, count2] = [int_cast(x, calls_file) for x in line.strip().split("\t")]
-			if chrom not in calls_per_interval: calls_per_interval[chrom] = {}
-			calls_per_interval[chrom][start] = [count1, count2]
-	return calls_per_interval
+		samples = inf.readline().strip().split("\t")[3:]
+		values  = np.fromstring(inf.read(), dtype=np.int64, sep=" ")
+	if samples != stats.samples:
+		print(f"the samples in {calls_file}, {samples}, do not match {stats.samples}")
+		exit(1)
+	values = values.reshape(-1, 3 + len(samples))
+	rows = stats.rows(values[:, 0], values[:, 1])
+	stats.calls[rows[rows >= 0]] = values[rows >= 0, 3:]
 
 
 ################
@@ -188,9 +211,10 @@ def set_column_widths(worksheet, style):
 	worksheet.set_column(column_string(4), 30)
 
 
-def write_header(worksheet, style):
-	header = ["chrom", "gene", "uniprot", "disease", "region",
-				"depth in CH", "depth in AH", "coverage in CH", "coverage in AH", "calls in CH", "calls in AH", ]
+def write_header(worksheet, style, samples):
+	header  = ["chrom", "gene", "uniprot", "disease", "region"]
+	header += [f"depth in {sample}" for sample in samples] + [f"coverage in {sample}" for sample in samples]
+	header += [f"calls in {sample}" for sample in samples]
 	worksheet.set_row(0, 40, style.xlsx_format["header"])
 	for column in range(len(header)):
 		worksheet.write_string(0, column, header[column])
@@ -204,43 +228,28 @@ def main():
 	vcf_dir = f"{home_path}/pileup/variants"
 	annotation_dir       = f"{home_path}/annotation"
 	calls_file           = f"{vcf_dir}/calls_per_interval.tsv"
-	ncbi_refseq          = f"{annotation_dir}/target_regions_annotated.bed"
+	ncbi_refseq          = annotation_index_file(f"{annotation_dir}/target_regions_annotated.bed")
 	gene_annotation_file = f"{annotation_dir}/gene_annotation.tsv"
 	check_exist([cvg_dir, annotation_dir, calls_file, ncbi_refseq, gene_annotation_file])
 
 	annotation = read_annotation(ncbi_refseq, gene_annotation_file)
 
-	# summarize coverage/depth for each region
-	[coverage, avg_depth, region_end] = summarize_coverage_pileup(cvg_dir)
-	calls_per_interval = read_calls_per_interval(calls_file)
-
-	# Create an new Excel file and add a worksheet.
-	workbook  = xlsxwriter.Workbook('region_summary.xlsx')
-	worksheet = workbook.add_worksheet("Summary for  AH and CH")
-	style = Styling(workbook)
-	set_column_widths(worksheet, style)
-	write_header(worksheet, style)
-
-	# write
-	row    = 1
-	column = 0
-	for chrom in sorted(coverage.keys()):
-		stats = [coverage[chrom], avg_depth[chrom], calls_per_interval[chrom]]
-		annotation.chrom = chrom
-		row_span = write_chromosome(worksheet, style, stats, region_end, annotation, row, column+1)
-		if not row_span: continue
-		# merge_range(first_row, first_col, last_row, last_col, data, cell_format=None)
-		if row_span == 1:
-			worksheet.write_string(row, column, f"chr{chrom}")
-		else:
-			worksheet.merge_range(row, column, row+row_span-1, column,  f"chr{chrom}")
+	# summarize coverage/depth and the calls for each region, (regions x samples)
+	samples = get_samples()
+	stats = summarize_coverage_pileup(cvg_dir, samples)
+	read_calls_per_interval(calls_file, stats)
 
-		row += row_span
+	# Create an new Excel file, in constant memory mode - the rows are written to disk as we go
+	workbook = xlsxwriter.Workbook('region_summary.xlsx', {'constant_memory': True})
+	report   = Report(workbook, Styling(workbook), samples)
 
+	for chrom in stats.chromosomes():
+		annotation.chrom = chrom
+		report.start_chromosome(chrom)
+		write_chromosome(report, stats, annotation)
 
 	workbook.close()
 
-
 	return
 
 
@@ -8,7 +8,6 @@ mkdir toy_pipeline/report
 cp report/report.tex  report/report.bib report/plos2009.bst toy_pipeline/report
 cp -r report/figures toy_pipeline/report
 cp -r fastqc toy_pipeline
-find toy_pipeline/fastqc -name "*.zip" | xargs rm -f
 mkdir toy_pipeline/task_dna
 mv toy_pipeline/python/README.md toy_pipeline/
 zip -r toy_pipeline.zip toy_pipeline/
@@ -0,0 +1,117 @@
+
+
+""" Finding the adapter sequences from the reads themselves
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+An adapter shows up at the 3' end of every read whose insert is shorter
+than the read, so the k-mers from the adapter are far more frequent among
+the read 3' ends than any k-mer from the genome. We take a sample of reads
+from across the file, count the k-mers in their 3' ends (2-bit encoded,
+and counted in a sorted numpy array rather than a dictionary), and extend
+the most frequent one, base by base, for as long as the reads containing
+it agree on the next base. The procedure is then repeated with the k-mers
+not explained by the adapters found so far.
+
+"""
+
+import numpy as np
+
+from config import Config
+from fastq_io import *
+
+
+# A, C, G, T -> 0-3, anything else (N) -> 4
+base_code = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate(b"ACGT"): base_code[base] = i
+
+
+def decode_kmer(code, k):
+	return "".join(["ACGT"[(code >> 2*(k-1-j)) & 3] for j in range(k)])
+
+
+def count_tail_kmers(seqs, k, tail_length):
+	# returns sorted distinct k-mer codes and their counts, for the last tail_length bases of each read
+	tails = [s[-tail_length:] for s in seqs if len(s) >= k]
+	if not tails: return [np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+	# pad the short reads (on the left, where the insert is) with N, which is never counted
+	window = max([len(t) for t in tails])
+	bases = base_code[np.frombuffer(b"".join([t.rjust(window, b"N") for t in tails]), dtype=np.uint8)]
+	bases = bases.reshape(len(tails), window)
+	positions = window - k + 1
+	codes = np.zeros((len(tails), positions), dtype=np.int64)
+	invalid = np.zeros((len(tails), positions), dtype=bool)
+	for j in range(k):
+		column = bases[:, j:j+positions]
+		codes = (codes << 2) | (column & 3)
+		invalid |= column > 3
+	return np.unique(codes[~invalid], return_counts=True)
+
+
+def low_complexity(kmer):
+	# poly-A, poly-G (two-color chemistry no-signal) and dinucleotide repeats
+	return len(set(kmer)) <= 2
+
+
+def consensus_base(bases, min_support):
+	if len(bases) < min_support: return None
+	values, counts = np.unique(np.frombuffer(bytes(bases), dtype=np.uint8), return_counts=True)
+	best = np.argmax(counts)
+	if counts[best] < Config.adapter_consensus*len(bases) or values[best] not in b"ACGT": return None
+	return chr(values[best])
+
+
+def assemble(seed, seqs):
+	# extend the seed both ways, for as long as the reads containing it agree on the next base
+	seed_bytes = seed.encode()
+	hits = [[s, s.find(seed_bytes)] for s in seqs]
+	hits = [[s, pos] for [s, pos] in hits if pos >= 0]
+	min_support = max(10, len(hits)//5)
+	adapter = seed
+	# to the left, the consensus falls apart where the insert starts - that is where the adapter begins
+	left = 0
+	while True:
+		bases = [s[pos-left-1] for [s, pos] in hits if pos-left-1 >= 0]
+		base = consensus_base(bases, min_support)
+		if not base: break
+		adapter = base + adapter
+		left += 1
+	# to the right, we go until the reads run out
+	right = len(seed)
+	while True:
+		bases = [s[pos+right] for [s, pos] in hits if pos+right < len(s)]
+		base = consensus_base(bases, min_support)
+		if not base: break
+		adapter += base
+		right += 1
+	return adapter
+
+
+def explained(kmer, assembled):
+	# the kmer is either from one of the sequences we have already assembled,
+	# or from the junction of the insert and the start of one of them
+	for sequence in assembled:
+		if kmer in sequence: return True
+		if any([sequence.startswith(kmer[j:]) for j in range(1, len(kmer)//2+1)]): return True
+	return False
+
+
+def find_adapters(fastq, max_adapters=3):
+	# the dominant adapter sequences in fastq, most abundant first
+	k = Config.adapter_kmer
+	seqs = sample_reads(fastq, Config.adapter_sample_reads)
+	if not seqs: return []
+	[kmers, counts] = count_tail_kmers(seqs, k, Config.adapter_tail_length)
+	order = np.argsort(counts)[::-1]
+	assembled = []
+	for idx in order:
+		# an adapter has to be in a noticeable fraction of the reads
+		if counts[idx] < Config.adapter_min_fraction*len(seqs) or len(assembled) >= max_adapters: break
+		kmer = decode_kmer(int(kmers[idx]), k)
+		if low_complexity(kmer) or explained(kmer, assembled): continue
+		sequence = assemble(kmer, seqs)
+		print(f"\t {fastq}: found adapter {sequence} (seed {kmer} in {counts[idx]} of {len(seqs)} sampled reads)")
+		assembled.append(sequence)
+	# cutadapt needs only so much of the adapter to recognize it
+	return [sequence[:Config.adapter_max_length] for sequence in assembled]
@@ -0,0 +1,150 @@
+
+
+""" Annotating the target regions by the genes they overlap
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+The gene annotation comes as a GTF (hg19.ncbiRefSeq.gtf, plain or
+gzipped, available from
+https://hgdownload.soe.ucsc.edu/goldenPath/hg19/bigZips/genes/).
+It is read only once: the features of the types we are interested in
+(Config.annotation_features) are kept in a numpy cache next to it,
+together with the size and the modification time of the GTF, and the
+feature types, so that the cache is rebuilt only if one of those changes.
+The features are then intersected with the merged target regions:
+both sorted by position, and the targets not overlapping each other,
+the targets overlapping a feature are a contiguous run, found for all
+features of a chromosome at once by numpy searchsorted. As in bedtools
+intersect, each overlap is reported as the part of the feature within
+the target. Both the GTF and the merged targets are 1-based, closed.
+
+The result goes to a bed file, and to a binary index (.npz) with
+the chromosome, start, end and gene for each overlap, which is what
+the subsequent stages read.
+
+Sources:
+https://www.ensembl.org/info/website/upload/gff.html
+https://bedtools.readthedocs.io/en/latest/content/tools/intersect.html
+
+"""
+
+import gzip, os
+
+import numpy as np
+
+
+def gtf_attribute(attributes, key):
+	# attributes: gene_id "BRCA2"; transcript_id "NM_000059"; ...
+	for field in attributes.split(";"):
+		field = field.strip()
+		if field.startswith(key + " "): return field[len(key)+1:].strip("\"")
+	return ""
+
+
+def gtf_stamp(gtf_file, features):
+	stat = os.stat(gtf_file)
+	return f"{os.path.abspath(gtf_file)} {stat.st_size} {stat.st_mtime_ns} {','.join(features)}"
+
+
+def read_gtf(gtf_file, features):
+	# [chrom names, chrom, start, end, gene_id, transcript_id, gene_name] for the features of the given types;
+	# the strings are stored once, and referred to by their index
+	features = set(features)
+	[chrom, start, end, gene_id, transcript_id, gene_name] = [[], [], [], [], [], []]
+	with (gzip.open(gtf_file, "rt") if gtf_file.endswith(".gz") else open(gtf_file)) as inf:
+		for line in inf:
+			if line[0] == "#": continue
+			fields = line.rstrip("\n").split("\t")
+			if len(fields) < 9 or fields[2] not in features: continue
+			chrom.append(fields[0])
+			start.append(int(fields[3]))
+			end.append(int(fields[4]))
+			gene_id.append(gtf_attribute(fields[8], "gene_id"))
+			transcript_id.append(gtf_attribute(fields[8], "transcript_id"))
+			gene_name.append(gtf_attribute(fields[8], "gene_name"))
+	table = {"start": np.array(start, dtype=np.int64), "end": np.array(end, dtype=np.int64)}
+	for [name, values] in [["chrom", chrom], ["gene_id", gene_id], ["transcript_id", transcript_id], ["gene_name", gene_name]]:
+		[table[f"{name}_names"], table[name]] = np.unique(np.array(values, dtype=str), return_inverse=True)
+	return table
+
+
+def gtf_features(gtf_file, features, cache_file):
+	# the features from the cache, if it was made from the same gtf, for the same feature types
+	stamp = gtf_stamp(gtf_file, features)
+	if os.path.exists(cache_file):
+		with np.load(cache_file) as cached:
+			if str(cached["stamp"]) == stamp: return {key: cached[key] for key in cached.files}
+	print(f"reading {gtf_file}")
+	table = read_gtf(gtf_file, features)
+	table["stamp"] = np.array(stamp)
+	# np.savez adds .npz to the name, unless it is there already
+	np.savez(f"{cache_file}.tmp.npz", **table)
+	os.replace(f"{cache_file}.tmp.npz", cache_file)
+	return table
+
+
+def intersect(table, merged_regions):
+	# returns the overlaps [chrom, start, end, feature] sorted by chromosome and position;
+	# merged_regions: {chrom number: sorted, non-overlapping [start, end] intervals}
+	overlaps = []
+	chrom_names = table["chrom_names"].tolist()
+	for chrom in sorted(merged_regions.keys()):
+		if f"chr{chrom}" not in chrom_names or not len(merged_regions[chrom]): continue
+		targets = np.array(merged_regions[chrom], dtype=np.int64)
+		on_chrom = np.flatnonzero(table["chrom"] == chrom_names.index(f"chr{chrom}"))
+		on_chrom = on_chrom[np.argsort(table["start"][on_chrom], kind="stable")]
+		[starts, ends] = [table["start"][on_chrom], table["end"][on_chrom]]
+		# targets from the first one ending at or after the feature start, to the last one starting at or before its end
+		first = np.searchsorted(targets[:, 1], starts, side="left")
+		last  = np.searchsorted(targets[:, 0], ends, side="right")
+		count = np.maximum(last - first, 0)
+		feature = np.repeat(np.arange(len(on_chrom)), count)
+		# the targets of each feature: first, first+1, ... first+count-1
+		target  = np.repeat(first, count) + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+		overlaps.append(np.column_stack([np.full(len(feature), chrom, dtype=np.int64),
+										np.maximum(starts[feature], targets[target, 0]),
+										np.minimum(ends[feature], targets[target, 1]),
+										on_chrom[feature]]))
+	if not overlaps: return np.zeros((0, 4), dtype=np.int64)
+	overlaps = np.concatenate(overlaps)
+	return overlaps[np.lexsort([overlaps[:, 2], overlaps[:, 1], overlaps[:, 0]])]
+
+
+def write_annotated_bed(bedfile, table, overlaps):
+	# the attributes are kept to those the pipeline uses
+	[gene_id, transcript_id, gene_name] = [table[f"{name}_names"][table[name]].tolist()
+											for name in ["gene_id", "transcript_id", "gene_name"]]
+	with open(bedfile, "w") as outf:
+		for [chrom, start, end, feature] in overlaps.tolist():
+			attributes = f"gene_id \"{gene_id[feature]}\"; transcript_id \"{transcript_id[feature]}\"; gene_name \"{gene_name[feature]}\";"
+			print(f"chr{chrom}\t{start}\t{end}\t{attributes}", file=outf)
+
+
+def annotation_index_file(bedfile):
+	return bedfile.replace(".bed", ".npz")
+
+
+def write_annotation_index(index_file, table, overlaps):
+	# only the gene names that actually appear, renumbered
+	[gene_names, gene] = np.unique(table["gene_name_names"][table["gene_name"][overlaps[:, 3]]], return_inverse=True)
+	np.savez(f"{index_file}.tmp.npz", chrom=overlaps[:, 0], start=overlaps[:, 1], end=overlaps[:, 2],
+				gene=gene.reshape(-1), gene_names=gene_names)
+	os.replace(f"{index_file}.tmp.npz", index_file)
+
+
+def read_annotation_index(index_file):
+	# {chrom number: [[start, end] intervals, gene name for each]}
+	with np.load(index_file) as index:
+		[chrom, start, end, gene, gene_names] = [index[key] for key in ["chrom", "start", "end", "gene", "gene_names"]]
+	annotation = {}
+	for chrom_number in np.unique(chrom).tolist():
+		on_chrom = chrom == chrom_number
+		annotation[chrom_number] = [np.column_stack([start[on_chrom], end[on_chrom]]).tolist(),
+									gene_names[gene[on_chrom]].tolist()]
+	return annotation
+
+
+def annotated_genes(index_file):
+	with np.load(index_file) as index:
+		return index["gene_names"].tolist()
@@ -0,0 +1,158 @@
+
+
+""" Reading BGZF (blocked gzip) files
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+BGZF, as produced by bgzip (and by htslib in general), is a series of
+gzip members, each holding at most 64KB of the original content, with the
+size of the compressed block stored in the gzip header. The blocks can
+therefore be found without decompressing anything, and decompressed
+independently of each other - zlib lets go of the GIL while working,
+so plain threads decompress them in parallel.
+
+A position in a BGZF file is given by a virtual offset: the file offset
+of the block start, shifted by 16 bits, plus the offset within the
+decompressed block. BgzfReader reads the lines from a virtual offset on
+(as an index, e.g. tabix, tells it to), keeping the recently used
+decompressed blocks in an LRU cache, so that nearby queries do not
+decompress the same blocks again.
+
+Sources:
+https://samtools.github.io/hts-specs/SAMv1.pdf (section 4.1)
+
+"""
+
+import struct, zlib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+
+
+bgzf_magic = b"\x1f\x8b\x08\x04"  # gzip, deflate, with the extra field
+
+
+def block_size(data, offset=0):
+	# the total size of the BGZF block starting at offset in data; 0 if there is no block header there
+	if data[offset:offset+4] != bgzf_magic or len(data) < offset+12: return 0
+	xlen = struct.unpack_from("<H", data, offset+10)[0]
+	extra = offset+12
+	if len(data) < extra+xlen: return 0
+	pos = extra
+	while pos+4 <= extra+xlen:
+		[si1, si2, slen] = struct.unpack_from("<BBH", data, pos)
+		if si1 == ord("B") and si2 == ord("C") and slen == 2:
+			return struct.unpack_from("<H", data, pos+4)[0] + 1
+		pos += 4 + slen
+	return 0
+
+
+def is_bgzf(path):
+	with open(path, "rb") as inf:
+		return block_size(inf.read(1 << 10)) > 0
+
+
+def next_block(data, offset=0):
+	# the offset of the first block header at or after offset (-1 if not found)
+	while True:
+		offset = data.find(bgzf_magic, offset)
+		if offset < 0 or block_size(data, offset): return offset
+		offset += 1
+
+
+def split_blocks(data, offset=0):
+	# [start, end] for each complete block from offset on
+	spans = []
+	while True:
+		size = block_size(data, offset)
+		if not size or offset+size > len(data): break
+		spans.append([offset, offset+size])
+		offset += size
+	return spans
+
+
+def inflate_block(data, start=0, end=None):
+	if end is None: end = start + block_size(data, start)
+	xlen = struct.unpack_from("<H", data, start+10)[0]
+	# raw deflate stream, between the header and the CRC32/ISIZE trailer
+	return zlib.decompress(memoryview(data)[start+12+xlen:end-8], -15)
+
+
+def inflate_blocks(data, spans):
+	return b"".join([inflate_block(data, start, end) for [start, end] in spans])
+
+
+def parallel_inflate(path, read_size=None, threads=None):
+	# yields the decompressed content of the file, in order, read_size compressed bytes at the time
+	if read_size is None: read_size = Config.bgzf_read_size
+	if threads is None: threads = Config.bgzf_threads
+	pending = deque()
+	leftover = b""
+	with open(path, "rb") as inf, ThreadPoolExecutor(threads) as executor:
+		while True:
+			data = inf.read(read_size)
+			buf = leftover + data
+			spans = split_blocks(buf)
+			if spans: pending.append(executor.submit(inflate_blocks, buf, spans))
+			leftover = buf[spans[-1][1]:] if spans else buf
+			# keep all the threads busy, but do not read ahead without a limit
+			while pending and (len(pending) > 2*threads or not data):
+				yield pending.popleft().result()
+			if not data: break
+	if leftover: print(f"truncated BGZF block at the end of {path}")
+
+
+class BgzfReader:
+	def __init__(self, path, cache_blocks=None):
+		self.path = path
+		self.file = open(path, "rb")
+		self.cache_blocks = Config.bgzf_cache_blocks if cache_blocks is None else cache_blocks
+		self.cache = OrderedDict()  # file offset of the block -> [decompressed block, file offset of the next block]
+
+	def close(self):
+		self.file.close()
+
+	def block(self, offset):
+		if offset in self.cache:
+			self.cache.move_to_end(offset)
+			return self.cache[offset]
+		self.file.seek(offset)
+		header = self.file.read(18)  # the usual BGZF header, with the BC field only
+		size = block_size(header)
+		if not size:
+			if header: print(f"no BGZF block at {offset} in {self.path}")
+			return [b"", offset]
+		data = header + self.file.read(size - len(header))
+		self.cache[offset] = [inflate_block(data, 0, size), offset + size]
+		if len(self.cache) > self.cache_blocks: self.cache.popitem(last=False)
+		return self.cache[offset]
+
+	def lines(self, start, end=None):
+		# yields the lines starting at virtual offsets from start up to (not including) end
+		offset = start >> 16
+		[data, next_offset] = self.block(offset)
+		pos = start & 0xffff
+		while True:
+			if pos >= len(data):
+				if not data: return  # the end of the file (the empty block)
+				offset = next_offset
+				[data, next_offset] = self.block(offset)
+				pos = 0
+				continue
+			if end is not None and (offset << 16 | pos) >= end: return
+			# the line may continue into the following blocks
+			line = b""
+			while True:
+				newline = data.find(b"\n", pos)
+				if newline >= 0:
+					line += data[pos:newline]
+					pos = newline + 1
+					break
+				line += data[pos:]
+				offset = next_offset
+				[data, next_offset] = self.block(offset)
+				pos = 0
+				if not data: break
+			yield line
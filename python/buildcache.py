@@ -0,0 +1,102 @@
+
+
+""" Content-hash build cache, used to skip the jobs whose inputs did not change
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+The signature of a job is the hash of the content of its input files,
+of the tools it uses (the executables themselves, as a proxy for their
+version), of the config fields it depends on, and of the stage script.
+If the signature matches the one recorded after the last successful run,
+and the outputs are still there, the job does not need to run again.
+Some stages produce different files depending on the data (the adapter
+cleanup trims only the lanes with adapters); those write a record
+naming the files they produced, and the files it names count as
+outputs too.
+
+"""
+
+import hashlib, json, os, glob, threading
+from config import Config
+from utils import listed_files
+
+
+class BuildCache:
+
+	def __init__(self, cache_dir):
+		self.cache_dir = cache_dir
+		os.makedirs(cache_dir, exist_ok=True)
+		# hashing a BAM takes a while, so we remember the digest of each file
+		# for as long as its size and modification time stay the same
+		self.digests_file = f"{cache_dir}/file_digests.json"
+		self.digests = {}
+		if os.path.exists(self.digests_file):
+			with open(self.digests_file) as inf:
+				self.digests = json.load(inf)
+		self.lock = threading.Lock()
+
+	def file_digest(self, path):
+		stat = os.stat(path)
+		stamp = [stat.st_size, stat.st_mtime_ns]
+		with self.lock:
+			if path in self.digests and self.digests[path][0] == stamp:
+				return self.digests[path][1]
+		sha = hashlib.sha256()
+		with open(path, "rb") as inf:
+			for block in iter(lambda: inf.read(1 << 20), b""):
+				sha.update(block)
+		with self.lock:
+			self.digests[path] = [stamp, sha.hexdigest()]
+		return sha.hexdigest()
+
+	def signature(self, job):
+		components = [f"script {self.file_digest(job.cmd[1])}"]
+		for pattern in job.inputs:
+			paths = sorted(glob.glob(pattern))
+			if not paths: components.append(f"{pattern} missing")
+			for path in paths:
+				components.append(f"{path} {self.file_digest(path)}")
+		for tool in job.tools:
+			path = getattr(Config, tool)
+			# a change in the path alone (e.g. a new version installed elsewhere) is a change too
+			digest = self.file_digest(path) if os.path.isfile(path) else "not a file"
+			components.append(f"{tool} {path} {digest}")
+		for field in job.config_fields:
+			components.append(f"{field} {repr(getattr(Config, field))}")
+		components += job.cmd[2:]  # the samples the job is processing
+		return hashlib.sha256("\n".join(components).encode()).hexdigest()
+
+	def signature_file(self, job):
+		return f"{self.cache_dir}/{job.name}.signature"
+
+	def listed_outputs(self, job):
+		# the outputs named in the job's output records (e.g. the trimmed fastqs, if there were any)
+		return [path for record in job.listed_outputs if os.path.exists(record)
+				for path in listed_files(record)]
+
+	def up_to_date(self, job, signature):
+		if not all([glob.glob(pattern) for pattern in job.outputs]): return False
+		if not all([os.path.exists(path) for path in self.listed_outputs(job)]): return False
+		if not os.path.exists(self.signature_file(job)): return False
+		with open(self.signature_file(job)) as inf:
+			return inf.read().strip() == signature
+
+	def record(self, job):
+		# the outputs of the job are hashed now, so that the jobs downstream do not have to
+		for pattern in job.outputs:
+			for path in glob.glob(pattern): self.file_digest(path)
+		for path in self.listed_outputs(job): self.file_digest(path)
+		# the signature is recomputed (the inputs might have been modified in place by the job)
+		signature = self.signature(job)
+		with open(self.signature_file(job), "w") as outf:
+			print(signature, file=outf)
+		self.save()
+
+	def forget(self, job):
+		if os.path.exists(self.signature_file(job)): os.remove(self.signature_file(job))
+
+	def save(self):
+		with self.lock:
+			with open(self.digests_file, "w") as outf:
+				json.dump(self.digests, outf)
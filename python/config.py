@@ -6,26 +6,102 @@ Ivana Mihalek,  2020
 
 """
 
+import os
+
 class Config:
 	dirtree = '''
 	.
 	├── python
 	└── task_dna
 	'''
+	# the core budget: the pipeline runner keeps up to max_parallel_jobs stage/sample jobs in flight,
+	# and each of them gets job_cores for its threads and workers; a stage run by hand gets all the cores
+	cores = os.cpu_count()
+	max_parallel_jobs = max(1, cores//4)
+	job_cores = max(1, cores//max_parallel_jobs) if os.environ.get("SEQINSPECTOR_RUNNER") else cores
+
 	fastqc = "/home/ivana/third/FastQC/fastqc"
-	unzip  = "/usr/bin/unzip"
+	# the number of fastq files FastQC processes at the same time,
+	# and the number of cores they share (passed as FastQC's --threads)
+	fastqc_workers = 8
+	fastqc_cores   = job_cores
+	# "fastqc" runs FastQC itself; "native" computes in-process the FastQC modules
+	# that the pipeline actually reads (see fastq_stats.py)
+	fastqc_engine  = "fastqc"
+	# the "native" engine reads the fastq in blocks of at most this many bytes over all its workers together
+	# (each block takes several times its size in numpy arrays while it is being processed)
+	fastq_stats_memory = 1 << 30
+	# python code reads fastq files in blocks of this many bytes
+	fastq_block_size = 64 << 20
+	# bgzipped fastq are decompressed by this many threads, reading this many compressed bytes at the time
+	bgzf_threads   = job_cores
+	bgzf_read_size = 4 << 20
+	# the number of decompressed blocks (64KB each at most) kept for the random access to bgzipped files
+	bgzf_cache_blocks = 256
 
 	cutadapt = "/usr/local/bin/cutadapt"
+	# cutadapt --cores (0 would be all available, regardless of the other jobs), and the gzip level
+	# of the trimmed fastq (1 is the fastest, and gives most of the size reduction)
+	cutadapt_cores = job_cores
+	trimmed_compression_level = 1
 	paired_reads_rootnames = ["AH_S1_L001", "CH_S2_L001"]
 	read_labels = ["R1", "R2"]
 
-	# TODO how do you make this systematic
 	# this is from here https://www.biostars.org/p/371399/
 	adapter_seq = {"Illumina Universal Adapter": "AGATCGGAAGAG"}
+	# for the samples FastQC flags, find the adapter sequences from the reads (see adapters.py):
+	# sample reads, count kmers in their 3' tails, and extend the frequent ones while the reads agree
+	adapter_discovery    = True
+	adapter_sample_reads = 200000
+	adapter_kmer         = 12
+	adapter_tail_length  = 32
+	adapter_min_fraction = 0.01  # of the sampled reads that the seed kmer should be found in
+	adapter_consensus    = 0.8   # fraction of reads that should agree on the next base
+	adapter_max_length   = 40
 
 	bwa = "/home/ivana/third/bwa-0.7.17/bwa"
 	reference_fasta = "/storage/databases/ucsc/goldenpath/hg19/hg19.fa"
+	# shared by all runs: the indices of the reference, with the manifest of their checksums (see reference.py)
+	reference_cache_dir = "/storage/databases/reference_cache"
 	samtools = "/home/ivana/third/samtools-1.11/samtools"
+	# bwa mem -t, and samtools -@ for the compression and sorting of the alignments
+	bwa_threads      = job_cores
+	# load the bwa index into shared memory (bwa shm) once, for all alignments to use, instead of
+	# each bwa run reading it from the disk; it is dropped at the end, if it was not there before
+	bwa_shm = False
+	samtools_threads = 4
+	# "sam": bwa writes sam, converted to bam afterwards (the old way); "bam": bwa is piped straight
+	# into bam; "sorted": bwa is piped through fixmate into a coordinate sorted bam (07 then only marks duplicates);
+	# "sharded": as "sorted", but in parallel chunks
+	alignment_output = "bam"
+	# "sharded" output: the read pairs are split into chunks of this many pairs, aligned (and sorted)
+	# by alignment_workers parallel bwa runs, sharing bwa_threads, and then merged; a failed chunk is retried
+	alignment_chunk_pairs = 2000000
+	alignment_workers     = 4
+	alignment_retries     = 2
+	# samtools sort -m, the memory for each of the samtools_threads
+	sort_memory = "768M"
+	# "streaming": collate, fixmate, sort and markdup connected by pipes, with no intermediate bam on the disk;
+	# "steps": each step writes its bam, which the next one reads (the old way)
+	dedup_mode = "streaming"
 	bcftools = "/home/ivana/third/bcftools-1.11/bcftools"
+	# "depth": a single samtools depth run over all target regions, summarized on the fly;
+	# "mpileup": samtools mpileup for each region, with the pileup kept in a file for each (see pileup.py)
+	coverage_engine = "depth"
+	# variant calling only in the target regions, split into this many shards, called in parallel
+	# (0: the whole bam at once, the old way)
+	variant_shards  = 32
+	variant_workers = job_cores
+	# for "mpileup": all regions in a single pileup file, with an index (rather than a file for each region),
+	# and the number of regions piled up at the same time
+	pileup_consolidated = True
+	pileup_workers      = job_cores
+
+	# the gene annotation, in the annotation directory, and the types of its features intersected with the targets;
+	# the GTF can also be used gzipped, as downloaded (hg19.ncbiRefSeq.gtf.gz)
+	annotation_gtf      = "hg19.ncbiRefSeq.gtf"
+	annotation_features = ["transcript", "exon"]
 
 	basic_uniprot = "/storage/databases/uniprot/uniprot_basic_info.tsv"
+	# gene name -> uniprot entry index, built from basic_uniprot (and rebuilt when it changes)
+	uniprot_index = "/storage/databases/uniprot/uniprot_basic_info.sqlite"
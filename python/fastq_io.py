@@ -0,0 +1,163 @@
+
+
+""" Reading fastq - plain, gzipped or bgzipped - in large blocks, and in chunks that can be processed in parallel
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+"""
+
+import os, gzip
+from config import Config
+from bgzf import *
+
+
+def compressed(fastq):
+	return fastq.endswith(".gz") or fastq.endswith(".bgz")
+
+
+def raw_blocks(fastq, start, end, block_size):
+	# yields the (decompressed) content of the file from start to end (the end of the file if None)
+	if compressed(fastq) and is_bgzf(fastq):
+		# bgzip output can also be called .gz, so we check the content rather than the name
+		yield from parallel_inflate(fastq)
+		return
+	with (gzip.open(fastq, "rb") if compressed(fastq) else open(fastq, "rb")) as inf:
+		if start: inf.seek(start)
+		position = start
+		while end is None or position < end:
+			data = inf.read(block_size if end is None else min(block_size, end-position))
+			if not data: break
+			position += len(data)
+			yield data
+
+
+def record_start(buf, pos):
+	# the offset of the first fastq record starting at or after pos in buf (-1 if none found)
+	# a line starting with @ can also be a quality line, so we check that
+	# the line two lines down starts with +, as the separator line does
+	while True:
+		if pos > 0:
+			pos = buf.find(b"\n", pos-1) + 1
+			if pos == 0: return -1
+		lines = buf[pos:].split(b"\n", 3)
+		if len(lines) < 4: return -1
+		if lines[0][:1] == b"@" and lines[2][:1] == b"+": return pos
+		pos += len(lines[0]) + 1
+
+
+def chunk_boundaries(fastq, number_of_chunks):
+	# split the file into byte ranges, each starting at the beginning of a record
+	# (a gzipped file has to be read from the start, so it is a single chunk, up to its end)
+	if compressed(fastq): return [[0, None]]
+	size = os.path.getsize(fastq)
+	boundaries = [0]
+	with open(fastq, "rb") as inf:
+		for i in range(1, number_of_chunks):
+			offset = size*i//number_of_chunks
+			if offset <= boundaries[-1]: continue
+			inf.seek(offset)
+			# a few records worth of bytes should be enough to find the start of one
+			buf = inf.read(1 << 16)
+			start = record_start(buf, 1)  # offset might already be at the start, but we do not know that
+			if start < 0: break
+			boundaries.append(offset + start)
+	boundaries.append(size)
+	return [[boundaries[i], boundaries[i+1]] for i in range(len(boundaries)-1)]
+
+
+def record_blocks(fastq, start=0, end=None, block_size=None):
+	# yields the lines of the records between the offsets start and end
+	# (the end of the file if end is None), a block of roughly block_size bytes at the time;
+	# each block holds complete records only, four lines each
+	if block_size is None: block_size = Config.fastq_block_size
+	leftover = b""
+	for data in raw_blocks(fastq, start, end, block_size):
+		lines = (leftover + data).split(b"\n")
+		# the records not complete in this block wait for the next one
+		complete = (len(lines)-1)//4
+		leftover = b"\n".join(lines[4*complete:])
+		if complete: yield lines[:4*complete]
+	lines = leftover.split(b"\n")
+	if lines[-1] == b"": lines.pop()
+	complete = len(lines)//4
+	if complete: yield lines[:4*complete]
+	if lines[4*complete:]:
+		print(f"incomplete record at the end of {fastq}: {lines[4*complete:]}")
+
+
+def read_blocks(fastq, start=0, end=None, block_size=None):
+	# yields [sequences, qualities] for the records between the offsets start and end
+	for lines in record_blocks(fastq, start, end, block_size):
+		yield [lines[1::4], lines[3::4]]
+
+
+def split_pairs(fastq_pair, chunk_pairs, chunk_prefix):
+	# splits R1 and R2 into chunks of chunk_pairs read pairs, the mates staying in the same chunk;
+	# yields [chunk number, [R1 chunk, R2 chunk]] as soon as each chunk is written; the chunks are
+	# gzipped at level 1 (bwa reads them as they are) - much less disk at little cost in time
+	readers = [record_blocks(fastq) for fastq in fastq_pair]
+	buffers = [[], []]
+	exhausted = [False, False]
+	chunk = 0
+	while True:
+		for side in range(2):
+			while len(buffers[side]) < 4*chunk_pairs and not exhausted[side]:
+				try:
+					buffers[side] += next(readers[side])
+				except StopIteration:
+					exhausted[side] = True
+		if not buffers[0] and not buffers[1]: break
+		size = min(4*chunk_pairs, len(buffers[0]), len(buffers[1]))
+		if size < min(4*chunk_pairs, max(len(buffers[0]), len(buffers[1]))):
+			print(f"the number of reads in {fastq_pair[0]} and {fastq_pair[1]} does not match")
+			exit(1)
+		chunk_files = [f"{chunk_prefix}.{chunk:04d}_{side+1}.fastq.gz" for side in range(2)]
+		for side in range(2):
+			with gzip.open(chunk_files[side], "wb", compresslevel=1) as outf:
+				outf.write(b"\n".join(buffers[side][:size]) + b"\n")
+			buffers[side] = buffers[side][size:]
+		yield [chunk, chunk_files]
+		chunk += 1
+
+
+def region_text(inf, offset, length, bgzf):
+	# about length bytes of the (decompressed) content, from around offset in the file
+	inf.seek(offset)
+	if not bgzf: return inf.read(length)
+	# a block holds at most 64KB, but we do not know how well it compressed - read generously
+	buf = inf.read(length//2 + (1 << 17))
+	first = next_block(buf)
+	if first < 0: return b""
+	return inflate_blocks(buf, split_blocks(buf, first))[:length]
+
+
+def sample_reads(fastq, number_of_reads, number_of_regions=32):
+	# sequences of roughly number_of_reads reads, taken from number_of_regions places
+	# spread evenly through the file - the file is never read as a whole
+	# (BGZF can be entered at any block, but for plain gzip the reads are taken from the top)
+	size = os.path.getsize(fastq)
+	bgzf = compressed(fastq) and is_bgzf(fastq)
+	per_region = max(1, number_of_reads//number_of_regions)
+	seqs = []
+	if bgzf or not compressed(fastq):
+		with open(fastq, "rb") as inf:
+			# estimate the number of bytes per record from the first few records
+			first = region_text(inf, 0, 1 << 16, bgzf)
+			records_in_first = max(1, (first.count(b"\n")-1)//4)
+			region_bytes = int(1.2*per_region*len(first)/records_in_first) + (1 << 12)
+			# the compressed size of the regions would be smaller, but this is only to decide if sampling is worth it
+			if region_bytes*number_of_regions < size:
+				for i in range(number_of_regions):
+					offset = size*i//number_of_regions
+					buf = region_text(inf, offset, region_bytes, bgzf)
+					start = record_start(buf, 1 if offset else 0)
+					if start < 0: continue
+					lines = buf[start:].split(b"\n")
+					seqs += lines[1:4*((len(lines)-1)//4):4][:per_region]
+				return seqs
+	# small file - we can just as well take the reads from the top, and stop when we have enough
+	for [block_seqs, block_quals] in read_blocks(fastq):
+		seqs += block_seqs[:number_of_reads-len(seqs)]
+		if len(seqs) >= number_of_reads: break
+	return seqs
@@ -0,0 +1,247 @@
+
+
+""" In-process fastq QC, an alternative to FastQC
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+Of the FastQC output, the pipeline reads only the summary flags and
+the Adapter Content table. Here we compute per base quality, per base
+N content, length distribution, overrepresented sequences and adapter
+content with numpy, and write them out in the FastQC format
+(fastqc_data.txt and summary.txt, in a zip archive), so that the
+parsers in the pipeline can read the output of either. The
+pass/warn/fail flags use the FastQC default limits. The file is
+split into chunks which are processed in parallel, each read in blocks
+small enough that all workers together stay within
+Config.fastq_stats_memory. The adapters are found by comparing the
+2-bit encoded 12-mer at each position in the block with the adapter
+12-mers. The overrepresented sequences are the exception: they are
+counted by a Counter, in python, not vectorised.
+
+Sources:
+https://github.com/s-andrews/FastQC (Configuration/limits.txt, adapter_list.txt)
+
+"""
+
+import os, zipfile
+from collections import Counter
+from multiprocessing import Pool
+
+import numpy as np
+
+from config import Config
+from fastq_io import *
+
+
+# FastQC's own list, in FastQC's order
+adapters = [["Illumina Universal Adapter",    "AGATCGGAAGAG"],
+			["Illumina Small RNA 3' Adapter", "TGGAATTCTCGG"],
+			["Illumina Small RNA 5' Adapter", "GATCGTCGGACT"],
+			["Nextera Transposase Sequence",  "CTGTCTCTTATA"],
+			["SOLID Small RNA Adapter",       "CGCCTTGGCCGT"]]
+
+max_phred = 94  # phred+33 encoded qualities fit in printable ascii
+# like FastQC, we track the first 100000 distinct sequences (in each chunk),
+# and count only those; long sequences are truncated to 50 bases
+overrep_distinct = 100000
+
+
+def empty_stats():
+	return {"reads": 0, "gc": 0, "at": 0,
+			"quality": np.zeros((0, max_phred), dtype=np.int64),  # position x phred
+			"n_count": np.zeros(0, dtype=np.int64),
+			"length":  np.zeros(0, dtype=np.int64),
+			"adapter": np.zeros((len(adapters), 0), dtype=np.int64),  # the first position the adapter is seen at
+			"sequences": Counter()}
+
+
+def padded_sum(a, b):
+	# sum of two arrays, with the last axis padded to the longer of the two
+	length = max(a.shape[-1], b.shape[-1])
+	pad = lambda x: np.pad(x, [(0, 0)]*(x.ndim-1) + [(0, length-x.shape[-1])])
+	return pad(a) + pad(b)
+
+
+# 2-bit code of each base, -1 for anything else (N)
+base_code = np.full(256, -1, dtype=np.int32)
+for i, base in enumerate(b"ACGT"): base_code[base] = i
+
+
+def kmer_hashes(seq, read_end, k):
+	# the 2-bit encoded k-mer starting at each position of the concatenated reads
+	# (-1 where the k-mer has an N, or runs past the end of its read)
+	code = base_code[seq]
+	hashes = np.zeros(max(len(seq)-k+1, 0), dtype=np.int32)
+	valid  = np.ones(len(hashes), dtype=bool)
+	for j in range(k):
+		window = code[j:j+len(hashes)]
+		hashes = (hashes << 2) | window
+		valid &= window >= 0
+	# read_end: for each position, the end of the read it is in
+	valid &= np.arange(len(hashes)) + k <= read_end[:len(hashes)]
+	hashes[~valid] = -1
+	return hashes
+
+
+def adapter_positions(seq, read_start, lengths, max_length):
+	# (adapters x positions): the number of reads in which each adapter is first seen at each position
+	adapter = np.zeros((len(adapters), max_length), dtype=np.int64)
+	k = len(adapters[0][1])  # FastQC's adapters are all 12-mers
+	read_end = np.repeat(read_start + lengths, lengths)
+	hashes = kmer_hashes(seq, read_end, k)
+	for i, [name, adapter_seq] in enumerate(adapters):
+		target = int(kmer_hashes(np.frombuffer(adapter_seq.encode(), dtype=np.uint8), np.array([k]), k)[0])
+		found = np.flatnonzero(hashes == target)
+		if not len(found): continue
+		# the first occurrence in each read (found is sorted, so np.unique gives the first index of each read)
+		read = np.searchsorted(read_start, found, side="right") - 1
+		[reads, first] = np.unique(read, return_index=True)
+		adapter[i] = np.bincount(found[first] - read_start[reads], minlength=max_length)
+	return adapter
+
+
+def block_stats(stats, seqs, quals):
+	lengths = np.fromiter(map(len, seqs), dtype=np.int32, count=len(seqs))
+	seq  = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+	# phred+33, clipped to the range we count, in uint8 throughout
+	qual = np.clip(np.frombuffer(b"".join(quals), dtype=np.uint8), 33, 33+max_phred-1) - np.uint8(33)
+	max_length = int(lengths.max()) if len(lengths) else 0
+	# the position of each base within its read (a block is well under 2GB, so int32 is enough)
+	read_start = (np.cumsum(lengths, dtype=np.int64) - lengths).astype(np.int32)
+	position = np.arange(len(seq), dtype=np.int32) - np.repeat(read_start, lengths)
+
+	stats["reads"] += len(seqs)
+	base_count = np.bincount(seq, minlength=256)
+	stats["gc"] += int(base_count[ord("G")] + base_count[ord("C")])
+	stats["at"] += int(base_count[ord("A")] + base_count[ord("T")])
+	quality = np.bincount(position*max_phred + qual, minlength=max_length*max_phred)
+	stats["quality"] = padded_sum(stats["quality"].T, quality.reshape(max_length, max_phred).T).T
+	stats["n_count"] = padded_sum(stats["n_count"], np.bincount(position[seq == ord("N")], minlength=max_length))
+	stats["length"]  = padded_sum(stats["length"], np.bincount(lengths))
+	stats["adapter"] = padded_sum(stats["adapter"], adapter_positions(seq, read_start, lengths, max_length))
+
+	# not vectorised: the distinct sequences are counted in python
+	truncated = [s[:50] if len(s) > 75 else s for s in seqs]
+	if len(stats["sequences"]) < overrep_distinct:
+		stats["sequences"].update(truncated)
+	else:
+		stats["sequences"].update([s for s in truncated if s in stats["sequences"]])
+
+
+def chunk_stats(chunk):
+	[fastq, start, end, block_size] = chunk
+	stats = empty_stats()
+	for [seqs, quals] in read_blocks(fastq, start, end, block_size):
+		block_stats(stats, seqs, quals)
+	return stats
+
+
+def merge_stats(stats, other):
+	for key in ["reads", "gc", "at"]: stats[key] += other[key]
+	stats["quality"] = padded_sum(stats["quality"].T, other["quality"].T).T
+	for key in ["n_count", "length", "adapter"]:
+		stats[key] = padded_sum(stats[key], other[key])
+	stats["sequences"].update(other["sequences"])
+
+
+def fastq_stats(fastq, cores=None):
+	if cores is None: cores = Config.fastqc_cores
+	boundaries = chunk_boundaries(fastq, cores)
+	workers = min(cores, len(boundaries))
+	# the blocks of all workers together within Config.fastq_stats_memory
+	block_size = max(1 << 20, min(Config.fastq_block_size, Config.fastq_stats_memory//workers))
+	chunks = [[fastq, start, end, block_size] for [start, end] in boundaries]
+	stats = empty_stats()
+	if len(chunks) == 1:
+		merge_stats(stats, chunk_stats(chunks[0]))
+	else:
+		with Pool(workers) as pool:
+			for other in pool.imap_unordered(chunk_stats, chunks): merge_stats(stats, other)
+	return stats
+
+
+########################################
+def percentile(cumulative, fraction):
+	# cumulative: position x phred cumulative counts
+	return np.argmax(cumulative >= fraction*cumulative[:, -1:], axis=1)
+
+
+def flag(value, warn, fail):
+	return "fail" if value > fail else ("warn" if value > warn else "pass")
+
+
+def fastqc_modules(stats, filename):
+	# [module name, flag, header, rows] for each module, in FastQC order
+	modules = []
+	reads = stats["reads"]
+	lengths = np.nonzero(stats["length"])[0]
+	length_range = f"{lengths[0]}" if len(lengths) and lengths[0] == lengths[-1] else \
+		(f"{lengths[0]}-{lengths[-1]}" if len(lengths) else "0")
+	gc_fraction = stats["gc"]/(stats["gc"] + stats["at"]) if stats["gc"] + stats["at"] else 0
+	rows = [["Filename", filename], ["File type", "Conventional base calls"],
+			["Encoding", "Sanger / Illumina 1.9"], ["Total Sequences", reads],
+			["Sequences flagged as poor quality", 0], ["Sequence length", length_range],
+			["%GC", int(round(100*gc_fraction))]]
+	modules.append(["Basic Statistics", "pass", ["Measure", "Value"], rows])
+
+	quality = stats["quality"]
+	covered = quality.sum(axis=1)
+	cumulative = np.cumsum(quality, axis=1)
+	mean = (quality*np.arange(max_phred)).sum(axis=1)/np.maximum(covered, 1)
+	[p10, lower, median, upper, p90] = [percentile(cumulative, f) for f in [0.1, 0.25, 0.5, 0.75, 0.9]]
+	rows = [[i+1, mean[i], median[i], lower[i], upper[i], p10[i], p90[i]] for i in range(len(covered))]
+	status = "pass"
+	if len(rows):
+		if lower.min() < 5 or median.min() < 20: status = "fail"
+		elif lower.min() < 10 or median.min() < 25: status = "warn"
+	modules.append(["Per base sequence quality", status,
+					["Base", "Mean", "Median", "Lower Quartile", "Upper Quartile", "10th Percentile", "90th Percentile"],
+					rows])
+
+	n_percent = 100*stats["n_count"]/np.maximum(covered, 1)
+	rows = [[i+1, n_percent[i]] for i in range(len(n_percent))]
+	status = flag(n_percent.max() if len(rows) else 0, 5, 20)
+	modules.append(["Per base N content", status, ["Base", "N-Count"], rows])
+
+	rows = [[length, stats["length"][length]] for length in lengths]
+	status = "fail" if stats["length"][:1].sum() else ("warn" if len(lengths) > 1 else "pass")
+	modules.append(["Sequence Length Distribution", status, ["Length", "Count"], rows])
+
+	rows = []
+	for [seq, count] in stats["sequences"].most_common():
+		percentage = 100*count/reads
+		if percentage <= 0.1: break
+		rows.append([seq.decode(), count, percentage, "No Hit"])
+	status = flag(rows[0][2] if rows else 0, 0.1, 1)
+	modules.append(["Overrepresented sequences", status, ["Sequence", "Count", "Percentage", "Possible Source"], rows])
+
+	# FastQC reports the percentage of reads in which the adapter was seen at or before each position
+	adapter_percent = 100*np.cumsum(stats["adapter"], axis=1)/max(reads, 1)
+	rows = [[i+1] + list(adapter_percent[:, i]) for i in range(adapter_percent.shape[1])]
+	status = flag(adapter_percent.max() if len(rows) else 0, 5, 10)
+	modules.append(["Adapter Content", status, ["Position"] + [a[0] for a in adapters], rows])
+
+	return modules
+
+
+def write_fastqc_output(modules, filename, fqcdir):
+	# the same layout as the zip archive FastQC produces
+	data = ["##FastQC\tseqinspector"]
+	for [module, status, header, rows] in modules:
+		data.append(f">>{module}\t{status}")
+		data.append("#" + "\t".join(header))
+		for row in rows:
+			data.append("\t".join([f"{x:.3f}" if isinstance(x, (float, np.floating)) else str(x) for x in row]))
+		data.append(">>END_MODULE")
+	summary = [f"{status.upper()}\t{module}\t{filename}" for [module, status, header, rows] in modules]
+	dirname = os.path.basename(fqcdir)
+	with zipfile.ZipFile(f"{fqcdir}.zip", "w", zipfile.ZIP_DEFLATED) as archive:
+		archive.writestr(f"{dirname}/fastqc_data.txt", "\n".join(data) + "\n")
+		archive.writestr(f"{dirname}/summary.txt", "\n".join(summary) + "\n")
+
+
+def native_fastqc(fastq, fqcdir):
+	print(f"fastq stats for {fastq}")
+	filename = os.path.basename(fastq)
+	write_fastqc_output(fastqc_modules(fastq_stats(fastq), filename), filename, fqcdir)
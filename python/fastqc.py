@@ -8,31 +8,83 @@ Ivana Mihalek,  2020
 """
 
 from utils import *
-import subprocess, os, shutil
+import subprocess, os, zipfile, functools
+from concurrent.futures import ThreadPoolExecutor
+from fastq_stats import native_fastqc
+
+
+class FastQCReport:
+	# the two files we need from the FastQC output, read straight from the zip archive
+	def __init__(self, zip_file):
+		with zipfile.ZipFile(zip_file) as archive:
+			# the archive has a single directory, named after the fastq file
+			member = {os.path.basename(name): name for name in archive.namelist()}
+			self.summary_lines = archive.read(member["summary.txt"]).decode().splitlines(keepends=True)
+			self.modules = parse_fastqc_data(archive.read(member["fastqc_data.txt"]).decode())
+
+	def flaglines(self):
+		return sorted([line for line in self.summary_lines if "WARN" in line or "FAIL" in line])
+
+
+def parse_fastqc_data(text):
+	# module name -> [status, column names, rows of fields]
+	modules = {}
+	name = None
+	for line in text.splitlines():
+		if line[:2] == "##": continue  # FastQC version
+		if line[:len(">>END_MODULE")] == ">>END_MODULE":
+			name = None
+		elif line[:2] == ">>":
+			[name, status] = line[2:].strip().split("\t")[:2]
+			modules[name] = [status, [], []]
+		elif not name:
+			continue
+		elif line[0] == "#":  # the header of the table - if there are two, the second one is
+			modules[name][1] = line[1:].strip().split("\t")
+		else:
+			modules[name][2].append(line.strip().split("\t"))
+	return modules
+
+
+@functools.lru_cache(maxsize=None)
+def cached_report(zip_file, mtime):
+	return FastQCReport(zip_file)
+
+
+def fastqc_report(out_dir, root, label):
+	# parsed once, unless the report was rewritten in the meantime
+	zip_file = f"{fastqc_dir(out_dir, root, label)}.zip"
+	return cached_report(zip_file, os.path.getmtime(zip_file))
+
+
+def fastqc_one(fastqc, fastq, out_dir, threads):
+	# run fastqc analyzer; options: q is for quiet, o outdir, t the number of threads
+	# (FastQC also sizes its memory by the number of threads - 250MB each)
+	# the results are read from the zip file FastQC produces (see FastQCReport), no need to unzip it
+	cmd = f"{fastqc} {fastq}  -q -t {threads} -o {out_dir}"
+	run_or_exit(cmd, f"fastqc failed for {fastq}")
 
 
 def run_fastqc(dependencies, paired_reads_root, read_labels):
-	[fastqc, unzip, dna_dir, out_dir] = dependencies
+	[fastqc, dna_dir, out_dir] = dependencies
 	print("running fastqc:")
+	fastq_files = []
 	for root in paired_reads_root:
 		for label in read_labels:
-			fastq = f"{dna_dir}/{root}_{label}.fastq"
-
-			# run fastqc analyzer; options: q is for quiet, o outdir
-			cmd = f"{fastqc} {fastq}  -q -o {out_dir}"
-			print(cmd)
-			subprocess.call(["bash", "-c", cmd])
-			# unzip the directory which we produced to access the summary file
-			# TODO check that the zip file was indeed produced
-			# remove old version - the name is the convention that fastqc uses
-			fqcdir = fastqc_dir(out_dir, root, label)
-			# there are some security issues with this function; outse of toy context organize differently
-			# https://docs.python.org/3/library/shutil.html#shutil.rmtree
-			if os.path.exists(fqcdir): shutil.rmtree(fqcdir)
-			# qq must come before the input (zip) file
-			cmd = f"{unzip} -qq {fqcdir}.zip  -d {out_dir}"
-			print(cmd)
-			subprocess.call(["bash", "-c", cmd])
+			fastq_files.append([fastq_file(dna_dir, root, label), fastqc_dir(out_dir, root, label)])
+	if Config.fastqc_engine == "native":
+		# one file at the time, each split into chunks processed in parallel
+		for [fastq, fqcdir] in fastq_files: native_fastqc(fastq, fqcdir)
+		print("fastqc done\n")
+		return
+	# FastQC mostly waits on a single core for each file, so we run all files at once,
+	# (at most Config.fastqc_workers at the time), and split the core budget between them
+	workers = max(1, min(len(fastq_files), Config.fastqc_workers))
+	threads = max(1, Config.fastqc_cores//workers)
+	with ThreadPoolExecutor(workers) as executor:
+		futures = [executor.submit(fastqc_one, fastqc, gz_alias(fastq, out_dir), out_dir, threads)
+				for [fastq, fqcdir] in fastq_files]
+		for future in futures: future.result()  # re-raises if anything went wrong in the worker
 	print("fastqc done\n")
 
 
@@ -41,9 +93,7 @@ def talk_fastqc(rootnames, read_labels, out_dir):
 		for label in read_labels:
 			print()
 			print(root, label)
-			fqcdir = fastqc_dir(out_dir, root, label)
-			with open(f"{fqcdir}/summary.txt") as inf:
-				flaglines  = sorted([line for line in inf if "WARN" in line or "FAIL" in line])
+			flaglines = fastqc_report(out_dir, root, label).flaglines()
 			if not flaglines:
 				print("fastq reports no issues")
 			else:
@@ -55,9 +105,7 @@ def fastqc_latex_table(rootnames, read_labels, out_dir):
 	issues = set()
 	for root in rootnames:
 		for label in read_labels:
-			fqcdir = fastqc_dir(out_dir, root, label)
-			with open(f"{fqcdir}/summary.txt") as inf:
-				flaglines  = sorted([line for line in inf if "WARN" in line or "FAIL" in line])
+			flaglines = fastqc_report(out_dir, root, label).flaglines()
 			if not flaglines: continue
 			for line in flaglines:
 				[flag, issue] = line.split("\t")[:2]
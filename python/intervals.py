@@ -0,0 +1,73 @@
+
+
+""" Merging and looking up genomic intervals
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+The intervals are [start, end] pairs, closed on both ends. Merging
+sorts them by start and sweeps through once (in numpy: an interval opens
+a new merged one if it starts beyond the running maximum of the ends
+before it), so an interval that bridges several others merges them all.
+IntervalIndex keeps the intervals sorted by start, together with the
+running maximum of their ends, so that both the interval containing a
+query and all intervals overlapping it are found by bisection, whether
+the intervals overlap each other or not; overlapping_batch does the
+bisections for a whole list of queries in one numpy call.
+
+"""
+
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+
+def merge_intervals(intervals):
+	# the touching intervals (the end of one is the start of the next) are merged too
+	if not len(intervals): return []
+	intervals = np.asarray(intervals, dtype=np.int64)
+	intervals = intervals[np.argsort(intervals[:, 0], kind="stable")]
+	[starts, ends] = [intervals[:, 0], intervals[:, 1]]
+	# the furthest any of the intervals so far reaches; a new merged interval starts where the next start is beyond it
+	reach = np.maximum.accumulate(ends)
+	new = np.ones(len(starts), dtype=bool)
+	new[1:] = starts[1:] > reach[:-1]
+	first = np.flatnonzero(new)
+	last  = np.append(first[1:], len(starts)) - 1
+	return np.column_stack([starts[first], reach[last]]).tolist()
+
+
+class IntervalIndex:
+	def __init__(self, intervals, values=None):
+		# values: optional, something to return for each interval instead of its index
+		intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+		order = np.argsort(intervals[:, 0], kind="stable")
+		# plain lists - bisect on them is faster than numpy for one query at the time
+		self.starts = intervals[order, 0].tolist()
+		self.ends   = intervals[order, 1].tolist()
+		self.values = [values[i] for i in order] if values is not None else order.tolist()
+		# max_end[i] is the largest end among the first i+1 intervals - it never decreases, so we can bisect it
+		self.max_end = np.maximum.accumulate(intervals[order, 1]).tolist() if len(order) else []
+
+	def __len__(self):
+		return len(self.starts)
+
+	def overlapping(self, start, end):
+		# all intervals with at least one position in [start, end], in the order of their start
+		# (only those with start <= end can overlap, and among those only from the first with max_end >= start)
+		first = bisect_left(self.max_end, start)
+		last  = bisect_right(self.starts, end)
+		return [self.values[i] for i in range(first, last) if self.ends[i] >= start]
+
+	def overlapping_batch(self, starts, ends):
+		# overlapping() for many queries at once - numpy does the bisections for all of them together
+		first = np.searchsorted(self.max_end, starts, side="left").tolist()
+		last  = np.searchsorted(self.starts, ends, side="right").tolist()
+		return [[self.values[i] for i in range(first[q], last[q]) if self.ends[i] >= starts[q]]
+				for q in range(len(starts))]
+
+	def containing(self, start, end):
+		# an interval that contains all of [start, end], or None
+		for i in range(bisect_left(self.max_end, end), bisect_right(self.starts, start)):
+			if self.ends[i] >= end: return self.values[i]
+		return None
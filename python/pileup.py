@@ -5,12 +5,119 @@
 Part of seqinspector toy NGS QC pipeline
 Ivana Mihalek,  2020
 
+Coverage can be computed in two ways (Config.coverage_engine). The
+original, "mpileup", runs samtools mpileup for each merged target region,
+and keeps the pileup for each region in its own file, or, with
+Config.pileup_consolidated, all in a single file with an index of the
+offset of each region. The "depth" engine
+runs samtools depth once, over all regions and all bam files, and
+sums up the depth and the covered positions for each region directly from
+its output stream, in numpy arrays, into a single summary file. Note that
+samtools depth, unlike mpileup, does not skip the anomalous read pairs,
+so the depths can come out slightly higher.
+
+Variant calling, with Config.variant_shards, looks at the merged target
+regions only: they are split into shards of similar total length, each
+shard is called (bcftools mpileup -R | bcftools call) in a separate
+process, Config.variant_workers at the time, and the shards are then
+concatenated into a single indexed vcf. The calls are summarized for all
+regions in a single pass through the vcf; the index is for the lookups of
+a single region (region_calls, see tabix.py).
+
+The per-region statistics of all samples are kept in RegionStats: the
+regions, sorted, and a (regions x samples) numpy array for each of the
+coverage, the average depth and the number of calls.
+
 """
 
-import subprocess, re, os
+import subprocess, re, os, shutil, gzip
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from config import Config
+from utils import int_cast, run_or_exit
+from intervals import merge_intervals, IntervalIndex
+from bgzf import is_bgzf, parallel_inflate
+from tabix import record_end, vcf_region
+
+
+# a position is considered covered if its depth is above this
+coverage_min_depth = 10
+coverage_summary = "coverage_summary.tsv"
+pileup_consolidated = "pileup_regions.tsv"
+pileup_index = "pileup_regions.index.tsv"
+
+
+def read_regions(merged_regions_fnm):
+	regions = {}
+	inf = open(merged_regions_fnm)
+	for line in inf:
+		fields = line.strip().split()[:3]
+		if len(fields) < 3: continue
+		[chrom, start, end]  = [int_cast(field.replace("chr",""), merged_regions_fnm) for field in fields]
+		if chrom not in regions: regions[chrom] = []
+		regions[chrom].append([start, end])
+	inf.close()
+	# sorted (and merged, should the file not have been) for lookup by bisection
+	return {chrom: merge_intervals(intervals) for chrom, intervals in regions.items()}
+
+
+def region_shards(regions, number_of_shards):
+	# split the regions, in genomic order, into contiguous shards of about the same total length
+	ordered = [[chrom, start, end] for chrom in sorted(regions.keys()) for [start, end] in regions[chrom]]
+	total = sum([end - start + 1 for [chrom, start, end] in ordered])
+	shards = [[]]
+	length = 0
+	for [chrom, start, end] in ordered:
+		if length >= total*len(shards)/number_of_shards and len(shards) < number_of_shards: shards.append([])
+		shards[-1].append([chrom, start, end])
+		length += end - start + 1
+	return [shard for shard in shards if shard]
+
+
+def call_shard(bcftools, ref_genome, bamfile, shard_regions, shard_vcf):
+	# .tsv regions file: 1-based, closed intervals (the same convention as our regions; a .bed would be 0-based)
+	regions_file = shard_vcf.replace(".vcf.gz", ".regions.tsv")
+	with open(regions_file, "w") as outf:
+		for [chrom, start, end] in shard_regions: print(f"chr{chrom}\t{start}\t{end}", file=outf)
+	# -R: jump to the regions using the bam index, rather than reading the whole bam; -Ou: no compression in the pipe
+	cmd  = f"set -o pipefail; {bcftools} mpileup -f {ref_genome} -R {regions_file} {bamfile} --max-depth 10000 -Ou 2> /dev/null | "
+	cmd += f"{bcftools} call -mv -Oz -o {shard_vcf}  2> /dev/null"
+	return subprocess.call(["bash", "-c", cmd])
+
+
+def output_pileup_vcf_sharded(bcftools, ref_genome, pileup_dir, bamfile, regions):
+	# variant calling restricted to the target regions, in shards called in parallel, and concatenated in order
+	root = bamfile.split("/")[-1][:-4]
+	shard_dir = f"{pileup_dir}/{root}_shards"
+	os.makedirs(shard_dir, exist_ok=True)
+	shards = region_shards(regions, Config.variant_shards)
+	shard_vcfs = [f"{shard_dir}/shard_{i:03d}.vcf.gz" for i in range(len(shards))]
+	print(f"calling variants in {bamfile}: {len(shards)} shards")
+	with ThreadPoolExecutor(Config.variant_workers) as executor:
+		retcodes = list(executor.map(lambda i: call_shard(bcftools, ref_genome, bamfile, shards[i], shard_vcfs[i]),
+									range(len(shards))))
+	failed = [i for i in range(len(shards)) if retcodes[i] != 0]
+	if failed:
+		print(f"variant calling failed for shards {failed} of {bamfile}")
+		exit(1)
+	vcf = f"{pileup_dir}/{root}.vcf.gz"
+	# the shards are in the genomic order, so simple concatenation gives a sorted vcf
+	cmd  = f"{bcftools} concat -Oz -o {vcf} {' '.join(shard_vcfs)} 2> /dev/null && "
+	cmd += f"{bcftools} index -f {vcf} 2> /dev/null"
+	print(cmd)
+	if subprocess.call(["bash", "-c", cmd]) != 0:
+		print(f"concatenating the shards of {bamfile} failed")
+		exit(1)
+	shutil.rmtree(shard_dir)
 
 
-def output_pileup_vcf(bcftools, ref_genome, pileup_dir, bamfiles):
+def output_pileup_vcf(bcftools, ref_genome, pileup_dir, bamfiles, regions=None):
+	# regions: merged target regions; if given (and Config.variant_shards is set), only those are looked at
+	if regions is not None and Config.variant_shards:
+		for bamfile in bamfiles: output_pileup_vcf_sharded(bcftools, ref_genome, pileup_dir, bamfile, regions)
+		return
 	for bamfile in bamfiles:
 		root = bamfile.split("/")[-1][:-4]
 		# https://samtools.github.io/bcftools/howtos/variant-calling.html
@@ -19,14 +126,24 @@ def output_pileup_vcf(bcftools, ref_genome, pileup_dir, bamfiles):
 		# https://github.com/samtools/bcftools/issues/668
 		cmd  = f"{bcftools} mpileup -f {ref_genome} {bamfile}  --max-depth 10000 | "
 		cmd += f"{bcftools} call -mv -Oz -o {pileup_dir}/{root}.vcf.gz  2> /dev/null"
-		print(cmd)
-		subprocess.call(["bash", "-c", cmd])
+		# pipefail, so that the failure of mpileup is not masked by bcftools call
+		run_or_exit(f"set -o pipefail; {cmd}", f"variant calling for {bamfile} failed", [f"{pileup_dir}/{root}.vcf.gz"])
 		# not sure why bcftools does not do it itself, bcs in bcftools view it is asking for index
-		cmd  = f"{bcftools} index {pileup_dir}/{root}.vcf.gz  2> /dev/null"
-		subprocess.call(["bash", "-c", cmd])
+		cmd  = f"{bcftools} index -f {pileup_dir}/{root}.vcf.gz  2> /dev/null"
+		run_or_exit(cmd, f"indexing {pileup_dir}/{root}.vcf.gz failed", [f"{pileup_dir}/{root}.vcf.gz.csi"])
+
+
+def mpileup_region(samtools, chrom, intv, bamfiles):
+	# Each input file produces a separate group of pileup columns in the output.
+	# -a : Output all positions, including those with zero depth.
+	cmd = f"{samtools} mpileup -a -r  chr{chrom}:{intv[0]}-{intv[1]} {' '.join(bamfiles)}   2> /dev/null"
+	return subprocess.check_output(["bash", "-c", cmd])
 
 
 def output_pileup_cvg(cvg_dir, samtools, merged_regions, bamfiles):
+	if Config.pileup_consolidated:
+		output_pileup_consolidated(cvg_dir, samtools, merged_regions, bamfiles)
+		return
 	for chrom, intervals in merged_regions.items():
 		for intv in intervals:
 			fromto = f"{intv[0]}-{intv[1]}"
@@ -34,80 +151,286 @@ def output_pileup_cvg(cvg_dir, samtools, merged_regions, bamfiles):
 			# Each input file produces a separate group of pileup columns in the output.
 			# -a : Output all positions, including those with zero depth.
 			cmd  = f"{samtools} mpileup -a -r  chr{chrom}:{fromto} "
-			cmd += f"-o {cvg_dir}/pileup_chr{chrom}_{fromto}.tsv {bamfiles[0]} {bamfiles[1]}   2> /dev/null"
-			# print(cmd)
-			subprocess.call(["bash", "-c", cmd])
+			cmd += f"-o {cvg_dir}/pileup_chr{chrom}_{fromto}.tsv {' '.join(bamfiles)}   2> /dev/null"
+			run_or_exit(cmd, f"pileup of chr{chrom}:{fromto} failed", [f"{cvg_dir}/pileup_chr{chrom}_{fromto}.tsv"])
+
+
+def output_pileup_consolidated(cvg_dir, samtools, merged_regions, bamfiles):
+	# all regions in a single file, one after another, and an index with the offset and the size
+	# of each region's pileup; the regions are piled up in parallel, and written in order
+	regions = [[chrom, intv] for chrom in sorted(merged_regions.keys()) for intv in merged_regions[chrom]]
+	workers = Config.pileup_workers
+	with open(f"{cvg_dir}/{pileup_consolidated}", "wb") as outf, \
+			open(f"{cvg_dir}/{pileup_index}", "w") as index, ThreadPoolExecutor(workers) as executor:
+		print("#chrom\tstart\tend\toffset\tsize", file=index)
+		# in batches, not to keep the pileup of all regions in memory
+		for batch in range(0, len(regions), 16*workers):
+			batch_regions = regions[batch:batch + 16*workers]
+			print(f"pileup for regions {batch+1}-{batch+len(batch_regions)} of {len(regions)}")
+			outputs = executor.map(lambda region: mpileup_region(samtools, region[0], region[1], bamfiles), batch_regions)
+			for [[chrom, intv], output] in zip(batch_regions, outputs):
+				print(f"{chrom}\t{intv[0]}\t{intv[1]}\t{outf.tell()}\t{len(output)}", file=index)
+				outf.write(output)
+
+
+def clear_coverage_output(cvg_dir):
+	# the output of an earlier run, possibly in a different format, should not be mistaken for the new one
+	for fnm in [coverage_summary, pileup_consolidated, pileup_index]:
+		if os.path.exists(f"{cvg_dir}/{fnm}"): os.remove(f"{cvg_dir}/{fnm}")
+	with os.scandir(cvg_dir) as entries:
+		for entry in entries:
+			if entry.name.startswith("pileup_chr"): os.remove(entry.path)
+
+
+def write_depth_bed(bedfile, merged_regions):
+	# BED is 0-based and half-open, while the regions are 1-based and closed (as in samtools -r chr:from-to)
+	with open(bedfile, "w") as outf:
+		for chrom in sorted(merged_regions.keys()):
+			for [start, end] in merged_regions[chrom]:
+				print(f"chr{chrom}\t{start-1}\t{end}", file=outf)
+
+
+def region_keys(chrom, position):
+	# a single sortable integer for a (chromosome, position) pair
+	return (np.asarray(chrom, dtype=np.int64) << 32) | np.asarray(position, dtype=np.int64)
+
+
+def accumulate_depth(block, starts, ends, totals, covered, lengths):
+	# block: lines of samtools depth output - chrom, position, and a depth column for each bam file
+	columns = 2 + totals.shape[1]
+	values = np.fromstring(block.replace(b"chr", b"").decode(), dtype=np.int64, sep=" ").reshape(-1, columns)
+	keys = region_keys(values[:, 0], values[:, 1])
+	region = np.searchsorted(starts, keys, side="right") - 1
+	inside = (region >= 0) & (keys <= ends[np.maximum(region, 0)])
+	region = region[inside]
+	depth  = values[inside, 2:]
+	lengths += np.bincount(region, minlength=len(starts))
+	for i in range(totals.shape[1]):
+		totals[:, i]  += np.bincount(region, weights=depth[:, i], minlength=len(starts)).astype(np.int64)
+		covered[:, i] += np.bincount(region[depth[:, i] > coverage_min_depth], minlength=len(starts))
+
+
+def output_coverage_depth(cvg_dir, samtools, merged_regions, bamfiles):
+	bedfile = f"{cvg_dir}/depth_regions.bed"
+	write_depth_bed(bedfile, merged_regions)
+	regions = [[chrom, start, end] for chrom in sorted(merged_regions.keys()) for [start, end] in merged_regions[chrom]]
+	starts  = region_keys([r[0] for r in regions], [r[1] for r in regions])
+	ends    = region_keys([r[0] for r in regions], [r[2] for r in regions])
+	totals  = np.zeros((len(regions), len(bamfiles)), dtype=np.int64)
+	covered = np.zeros((len(regions), len(bamfiles)), dtype=np.int64)
+	lengths = np.zeros(len(regions), dtype=np.int64)
 
+	# -a: all positions, including those with zero depth; -b: only the positions in the regions;
+	# -q 13: the same minimum base quality mpileup uses by default
+	cmd = f"{samtools} depth -a -q 13 -b {bedfile} {' '.join(bamfiles)} 2> /dev/null"
+	print(cmd)
+	process = subprocess.Popen(["bash", "-c", cmd], stdout=subprocess.PIPE)
+	leftover = b""
+	while True:
+		data = process.stdout.read(Config.fastq_block_size)
+		if not data: break
+		block = leftover + data
+		last_newline = block.rfind(b"\n") + 1
+		leftover = block[last_newline:]
+		if last_newline: accumulate_depth(block[:last_newline], starts, ends, totals, covered, lengths)
+	if leftover: accumulate_depth(leftover, starts, ends, totals, covered, lengths)
+	if process.wait() != 0:
+		print("samtools depth failed")
+		exit(1)
 
-def summarize_variant_pileup(bcftools, big_vcf_file, regions):
+	with open(f"{cvg_dir}/{coverage_summary}", "w") as outf:
+		header = ["chrom", "start", "end", "positions"]
+		for bamfile in bamfiles:
+			# the sample name, AH_S1 for AH_S1.dedup.bam
+			root = os.path.basename(bamfile).split(".")[0]
+			header += [f"depth_total:{root}", f"covered:{root}"]
+		print("#" + "\t".join(header), file=outf)
+		for r, [chrom, start, end] in enumerate(regions):
+			row = [chrom, start, end, lengths[r]]
+			for i in range(len(bamfiles)): row += [totals[r, i], covered[r, i]]
+			print("\t".join([str(x) for x in row]), file=outf)
+
+
+def vcf_blocks(vcf_file):
+	# the decompressed content of a (b)gzipped vcf, in large blocks
+	if is_bgzf(vcf_file):
+		yield from parallel_inflate(vcf_file)
+		return
+	with gzip.open(vcf_file, "rb") as inf:
+		for block in iter(lambda: inf.read(Config.fastq_block_size), b""): yield block
+
+
+def vcf_records(vcf_file):
+	# yields the data lines of the vcf, undecoded, without the header
+	leftover = b""
+	for block in vcf_blocks(vcf_file):
+		lines = (leftover + block).split(b"\n")
+		leftover = lines.pop()
+		for line in lines:
+			if line and line[0] != ord("#"): yield line
+	if leftover and leftover[0] != ord("#"): yield leftover
+
+
+def quality_call(qual):
+	# QUAL gives an estimate of how likely it is to observe a call purely by chance
+	# QUAL>=20 is some zeroth order check for the meaninfulness of the call
+	# see https://samtools.github.io/bcftools/howtos/variant-calling.html
+	return qual not in [b".", "."] and float(qual) >= 20
+
+
+def streamed_region_calls(big_vcf_file, regions):
+	# yields [chrom, region starts, position, phred likelihood] for the quality calls in the regions:
+	# a single pass through the vcf; each record goes to the region(s) it overlaps, found by bisection
+	index = {chrom: IntervalIndex(intervals, [intv[0] for intv in intervals]) for chrom, intervals in regions.items()}
+	for line in vcf_records(big_vcf_file):
+		fields = line.split(b"\t", 6)
+		chrom_name = fields[0].decode().replace("chr", "")
+		if not chrom_name.isdigit() or int(chrom_name) not in index: continue
+		chrom = int(chrom_name)
+		if not quality_call(fields[5]): continue
+		position = int(fields[1])
+		# a deletion can reach into the region from before its start (and so can a record with END in INFO)
+		end = record_end(line.decode().split("\t")) if b"END=" in line else position + len(fields[3]) - 1
+		starts = index[chrom].overlapping(position, end)
+		if not starts: continue
+		yield [chrom, starts, fields[1].decode(), line.rsplit(b"\t", 1)[1].decode()]
+
+
+def region_calls(vcf_file, chrom, start, end):
+	# [position, phred likelihood] for the quality calls in a single region, looked up in the vcf index
+	# (for many regions at once, a pass through the whole vcf, as in summarize_variant_pileup, is faster)
+	return [[fields[1], fields[-1]] for fields in vcf_region(vcf_file, f"chr{chrom}", start, end)
+			if quality_call(fields[5])]
+
+
+def summarize_variant_pileup(big_vcf_file, regions):
 	# genotype deciphering scheme https://samtools.github.io/hts-specs/VCFv4.1.pdf, p 6
 	#  / is unresolverd and | resolved phenotype
 	# alleles are indexed from 0; the list order of genotype j/k is j+k*(k+1)/2) (upper triangular?)
 	# eg for r biallelic sites the ordering is:  AA,AB,BB; for triallelic:  AA,AB,BB,AC,BC,CC, etc.
+	# the same records bcftools view -r chrN:from-to would output for each region
 	phred_likelihoods = {}
-	for chrom, intervals in regions.items():
-		print(chrom, len(intervals))
-		for intv in intervals:
-			fromto = f"{intv[0]}-{intv[1]}"
-			# -H: suppress header
-			# -O: output format v (plain VCF)
-			# QUAL gives an estimate of how likely it is to observe a call purely by chance
-			# '%QUAL>=20' is some zeroth order check for the meaninfulness of the call
-			# see https://samtools.github.io/bcftools/howtos/variant-calling.html
-			cmd = f"{bcftools} view -H  -Ov -i '%QUAL>=20' -r chr{chrom}:{fromto} {big_vcf_file} "
-			output = subprocess.check_output(["bash", "-c", cmd])
-			if not output: continue
-			for line in output.decode().split("\n"):
-				if not line: continue
-				fields = line.split("\t")
-				position = fields[1]
-				phred_likelihood = fields[-1]
-				if chrom not in phred_likelihoods: phred_likelihoods[chrom] = {}
-				if intv[0] not in phred_likelihoods[chrom]: phred_likelihoods[chrom][intv[0]] = []
-				phred_likelihoods[chrom][intv[0]].append([position, phred_likelihood])
+	for [chrom, starts, position, phred_likelihood] in streamed_region_calls(big_vcf_file, regions):
+		if chrom not in phred_likelihoods: phred_likelihoods[chrom] = {}
+		for start in starts:
+			if start not in phred_likelihoods[chrom]: phred_likelihoods[chrom][start] = []
+			phred_likelihoods[chrom][start].append([position, phred_likelihood])
 	return phred_likelihoods
 
 
-def summarize_coverage_pileup(cvg_dir):
-	pileups = [fnm for  fnm in os.listdir(cvg_dir) if "pileup" in fnm]
-	coverage   = {}
-	avg_depth  = {}
-	region_end = {}
-	max_depth = -1
+class RegionStats:
+	# the per-region statistics of all samples: the regions sorted by chromosome and start, and for each
+	# statistic a (regions x samples) array, the columns in the order of the samples
+	def __init__(self, samples, regions):
+		# regions: [chrom, start, end] for each region
+		regions = np.asarray(regions, dtype=np.int64).reshape(-1, 3)
+		regions = regions[np.lexsort([regions[:, 1], regions[:, 0]])]
+		[self.chrom, self.start, self.end] = [regions[:, 0], regions[:, 1], regions[:, 2]]
+		self.samples   = list(samples)
+		self.coverage  = np.zeros((len(regions), len(self.samples)))
+		self.avg_depth = np.zeros((len(regions), len(self.samples)))
+		self.calls     = np.zeros((len(regions), len(self.samples)), dtype=np.int64)
+
+	def __len__(self):
+		return len(self.start)
+
+	def chromosomes(self):
+		return np.unique(self.chrom).tolist()
+
+	def chromosome(self, chrom):
+		# the rows of the regions on chrom - a contiguous range, the regions being sorted
+		[first, last] = np.searchsorted(self.chrom, [chrom, chrom+1]).tolist()
+		return range(first, last)
+
+	def rows(self, chrom, start):
+		# the row of each of the (chrom, start) regions, -1 for those that are not in the table
+		keys  = region_keys(self.chrom, self.start)
+		query = np.atleast_1d(region_keys(chrom, start))
+		if not len(keys): return np.full(len(query), -1)
+		row = np.minimum(np.searchsorted(keys, query), len(keys)-1)
+		return np.where(keys[row] == query, row, -1)
+
+
+def summarize_coverage_summary(cvg_dir, samples):
+	# RegionStats, from the output of the "depth" engine
+	with open(f"{cvg_dir}/{coverage_summary}") as inf:
+		header = inf.readline().lstrip("#").strip().split("\t")
+		values = np.fromstring(inf.read(), dtype=np.int64, sep=" ")
+	# chrom, start, end, positions, and a pair of columns, total depth and covered positions, for each bam file;
+	# the columns must be those of the samples we are reporting on, in the same order
+	# (split at the dot, as an older summary may have the bam name, AH_S1.dedup)
+	summary_samples = [column.split(":", 1)[1].split(".")[0] for column in header if column.startswith("depth_total:")]
+	if summary_samples != samples:
+		print(f"the samples in {cvg_dir}/{coverage_summary}, {summary_samples}, do not match {samples}")
+		exit(1)
+	columns = 4 + 2*len(samples)
+	if len(values) % columns:
+		print(f"{cvg_dir}/{coverage_summary} does not have the columns for {len(samples)} samples")
+		exit(1)
+	values = values.reshape(-1, columns)
+	values = values[values[:, 3] > 0]  # no positions in the region - nothing to report
+	stats = RegionStats(samples, values[:, :3])
+	# RegionStats sorts the regions; the summary should be sorted already, but just in case
+	values = values[np.lexsort([values[:, 1], values[:, 0]])]
+	stats.coverage  = values[:, 5::2]/values[:, 3:4]
+	stats.avg_depth = values[:, 4::2]/values[:, 3:4]
+	return stats
+
+
+def pileup_depths(text):
+	# the depth columns of mpileup output, as a (positions x bam files) array
+	if not text: return np.zeros((0, 0), dtype=np.int64)
+	# note this works only if there are no special flags in output_pileup mpileup command
+	# (if there are, the column content is different)
+	# see http://www.htslib.org/doc/samtools-mpileup.html
+	columns = text[:text.find(b"\n")].count(b"\t") + 1  # chrom, pos, ref, and depth, bases, qualities for each bam
+	fields = text.replace(b"\n", b"\t").split(b"\t")
+	if fields[-1] == b"": fields.pop()
+	return np.array([np.array(fields[i::columns]).astype(np.int64) for i in range(3, columns, 3)]).T
+
+
+def add_region(regions, coverage, avg_depth, chrom, start, end, depth):
+	if not len(depth): return
+	regions.append([chrom, start, end])
+	# one value for each bam file, in the order they were given to mpileup
+	coverage.append((depth > coverage_min_depth).sum(axis=0)/len(depth))
+	avg_depth.append(depth.sum(axis=0)/len(depth))
+
+
+def region_pileups(cvg_dir):
+	# yields [chrom, start, end, pileup text] for each region
+	if os.path.exists(f"{cvg_dir}/{pileup_index}"):
+		# a single file, with the index telling where each region is
+		with open(f"{cvg_dir}/{pileup_index}") as index, open(f"{cvg_dir}/{pileup_consolidated}", "rb") as inf:
+			for line in index:
+				if line[0] == "#": continue
+				[chrom, start, end, offset, size] = [int(f) for f in line.split("\t")]
+				inf.seek(offset)
+				yield [chrom, start, end, inf.read(size)]
+		return
+	# a file for each region, named pileup_chr{chrom}_{start}-{end}.tsv
+	pileups = [fnm for fnm in os.listdir(cvg_dir) if fnm.startswith("pileup_chr")]
 	for fnm in pileups:
 		fields = re.split("_|-", fnm.replace("pileup_", "").replace(".tsv", "").replace("chr", ""))
 		[chrom, start, end] = [int(f) for f  in  fields]
-		region_end[start] = end
-		depth_total   = [0, 0]  # the first column refers to bamfiles[0], the second to  bamfiles[1]
-		depth_nonzero = [0, 0]
-		region_length = 0
-		with open(f"{cvg_dir}/{fnm}") as inf:
-			for line in inf:
-				field = line.split("\t")
-				# note this works only if there are no special flags in output_pileup mpileup command
-				# (if there are, the column content is different)
-				# see http://www.htslib.org/doc/samtools-mpileup.html
-				depth = [int(field[3]), int(field[6])]
-				region_length += 1
-				for i in range(2):
-					depth_total[i]   += depth[i]
-					depth_nonzero[i] += 1 if depth[i]>10 else 0
-					if max_depth<depth[i]: max_depth=depth[i]
-
-		if region_length:
-			if chrom not in coverage:
-				coverage[chrom]  = {}
-				avg_depth[chrom] = {}
-			coverage[chrom][start]  = [0, 0]
-			avg_depth[chrom][start] = [0, 0]
-			for i in range(2):
-				coverage[chrom][start][i]  = depth_nonzero[i]/region_length
-				avg_depth[chrom][start][i] = depth_total[i]/region_length
-
-	# print(max_depth)
-	# fmt = "%3d  %10d      %.2f  %8.3f       %.2f  %8.3f  "
-	# for chrom in sorted(coverage.keys()):
-	# 	for start in sorted(coverage[chrom].keys()):
-	# 		print(fmt%(chrom, start, coverage[chrom][start][0], avg_depth[chrom][start][0],
-	# 				 coverage[chrom][start][1], avg_depth[chrom][start][1]))
-	return [coverage, avg_depth, region_end]
+		with open(f"{cvg_dir}/{fnm}", "rb") as inf:
+			yield [chrom, start, end, inf.read()]
+
+
+def summarize_coverage_pileup(cvg_dir, samples):
+	# RegionStats with the coverage and the average depth in each region, for each of the samples
+	# (the samples in the order their bam files were given to samtools)
+	if os.path.exists(f"{cvg_dir}/{coverage_summary}"): return summarize_coverage_summary(cvg_dir, samples)
+	[regions, coverage, avg_depth] = [[], [], []]
+	for [chrom, start, end, text] in region_pileups(cvg_dir):
+		depth = pileup_depths(text)
+		if len(depth) and depth.shape[1] != len(samples):
+			print(f"the pileup for chr{chrom}:{start}-{end} has {depth.shape[1]} samples, expected {len(samples)}")
+			exit(1)
+		add_region(regions, coverage, avg_depth, chrom, start, end, depth)
+	stats = RegionStats(samples, regions)
+	if regions:
+		order = np.lexsort([np.array(regions)[:, 1], np.array(regions)[:, 0]])
+		stats.coverage  = np.array(coverage)[order]
+		stats.avg_depth = np.array(avg_depth)[order]
+	return stats
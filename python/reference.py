@@ -0,0 +1,209 @@
+
+
+""" Reference genome and its indices
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+The indices of the reference - bwa index (.amb, .ann, .bwt, .pac, .sa),
+samtools faidx (.fai) and the sequence dictionary (.dict) - are kept in
+a cache directory, Config.reference_cache_dir, one subdirectory for each
+reference fasta, with a symlink to the fasta, so that all runs (and all
+users) can share them. The checksums of the index files are recorded
+in a manifest, and the pieces that are missing, or do not match the
+manifest, are (re)built - only those, and in parallel. The indices that
+were made earlier next to the fasta itself (e.g. hg19.fa.bwt next to
+hg19.fa) are not rebuilt, but linked into the cache (hardlinked, or
+symlinked if the cache is on another filesystem), provided they are not
+older than the fasta, and recorded in the manifest. The checksum is
+recomputed only if the size or the modification time of a file changed.
+If the fasta itself changes, all indices are rebuilt. The finished
+index files are made read-only, and a lock keeps the runs that arrive
+at the same time from building the same thing. A complete cache is
+only read - no lock, no manifest update - so that it can be shared
+read-only.
+
+With Config.bwa_shm the bwa index is loaded into the shared memory,
+where each bwa mem finds it without having to read it from the disk.
+Note that bwa can only drop all of the shared indices at once.
+
+Sources:
+https://github.com/lh3/bwa
+https://github.com/lh3/bwa/blob/master/bwashm.c
+http://www.htslib.org/doc/samtools-faidx.html
+http://www.htslib.org/doc/samtools-dict.html
+
+"""
+
+import fcntl, hashlib, json, os, re, subprocess, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+
+
+def sha256sum(path):
+	sha = hashlib.sha256()
+	with open(path, "rb") as inf:
+		for block in iter(lambda: inf.read(1 << 24), b""): sha.update(block)
+	return sha.hexdigest()
+
+
+def file_record(path, recorded=None):
+	# [size, mtime_ns, sha256]; the checksum is taken from the recorded one if the size and the time did not change
+	stat = os.stat(path)
+	if recorded and recorded[:2] == [stat.st_size, stat.st_mtime_ns]: return recorded
+	return [stat.st_size, stat.st_mtime_ns, sha256sum(path)]
+
+
+def reference_dir(reference_fasta):
+	# one subdirectory for each fasta, named after it (and its location, to tell apart the fastas of the same name)
+	fasta = os.path.abspath(reference_fasta)
+	location = hashlib.sha1(fasta.encode()).hexdigest()[:8]
+	return f"{Config.reference_cache_dir}/{os.path.basename(fasta)}.{location}"
+
+
+def index_pieces(bwa, samtools, fasta):
+	# piece name -> [the files it consists of, the command that builds them]
+	stem = re.sub(r"\.(fa|fasta|fna)(\.gz)?$", "", fasta)
+	return {"bwa":  [[fasta + ext for ext in [".amb", ".ann", ".bwt", ".pac", ".sa"]],
+					f"{bwa} index -a bwtsw {fasta} 2> /dev/null"],
+			"fai":  [[f"{fasta}.fai"], f"{samtools} faidx {fasta} 2> /dev/null"],
+			"dict": [[f"{stem}.dict"], f"{samtools} dict -o {stem}.dict {fasta} 2> /dev/null"]}
+
+
+def read_manifest(manifest_file):
+	if not os.path.exists(manifest_file): return {"fasta": None, "files": {}}
+	with open(manifest_file) as inf:
+		return json.load(inf)
+
+
+def write_manifest(manifest_file, manifest):
+	with open(f"{manifest_file}.tmp", "w") as outf:
+		json.dump(manifest, outf, indent=1)
+	os.replace(f"{manifest_file}.tmp", manifest_file)
+
+
+def piece_valid(files, manifest):
+	for path in files:
+		name = os.path.basename(path)
+		if not os.path.exists(path) or name not in manifest["files"]: return False
+		record = file_record(path, manifest["files"][name])
+		if record[2] != manifest["files"][name][2]:
+			print(f"{path} does not match the checksum in the manifest")
+			return False
+		manifest["files"][name] = record  # only touched - remember the new time, not to checksum it again
+	return True
+
+
+def existing_piece(files, source_dir, fasta_mtime):
+	# the same files next to the original fasta, if all of them are there, and none is older than the fasta
+	existing = [f"{source_dir}/{os.path.basename(path)}" for path in files]
+	for path in existing:
+		if not os.path.exists(path) or os.stat(path).st_mtime_ns < fasta_mtime: return None
+	return existing
+
+
+def import_piece(files, existing):
+	# nothing is copied: a hardlink if the cache is on the same filesystem, a symlink otherwise
+	for [path, source] in zip(files, existing):
+		if os.path.lexists(path): os.remove(path)
+		try:
+			os.link(source, path)
+		except OSError:
+			os.symlink(source, path)
+
+
+def build_piece(files, cmd):
+	for path in files:
+		if os.path.exists(path): os.remove(path)
+	print(cmd)
+	return subprocess.call(["bash", "-c", cmd])
+
+
+def reference_ready(reference_fasta, fasta, manifest_file, pieces):
+	# all indices there and matching the manifest, which matches the fasta - checked without writing anything
+	if not os.path.lexists(fasta) or not os.path.exists(manifest_file): return False
+	manifest = read_manifest(manifest_file)
+	if not manifest["fasta"]: return False
+	if file_record(os.path.abspath(reference_fasta), manifest["fasta"])[2] != manifest["fasta"][2]: return False
+	return all([piece_valid(files, manifest) for [files, cmd] in pieces.values()])
+
+
+def prepare_reference(reference_fasta, bwa=None, samtools=None):
+	# returns the path to use for the reference - the fasta symlink in the cache, with all indices next to it
+	if bwa is None: bwa = Config.bwa
+	if samtools is None: samtools = Config.samtools
+	directory = reference_dir(reference_fasta)
+	fasta = f"{directory}/{os.path.basename(reference_fasta)}"
+	manifest_file = f"{directory}/manifest.json"
+	# the usual case, the cache is complete: the runs without write access to it can use it too
+	if reference_ready(reference_fasta, fasta, manifest_file, index_pieces(bwa, samtools, fasta)): return fasta
+
+	os.makedirs(directory, exist_ok=True)
+	if not os.path.lexists(fasta): os.symlink(os.path.abspath(reference_fasta), fasta)
+
+	with open(f"{directory}/.lock", "a") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file is closed
+		manifest = read_manifest(manifest_file)
+		fasta_record = file_record(os.path.abspath(reference_fasta), manifest["fasta"])
+		if manifest["fasta"] and fasta_record[2] != manifest["fasta"][2]:
+			print(f"{reference_fasta} changed - the indices will be rebuilt")
+			manifest["files"] = {}
+		manifest["fasta"] = fasta_record
+
+		pieces = index_pieces(bwa, samtools, fasta)
+		missing = [name for name, [files, cmd] in pieces.items() if not piece_valid(files, manifest)]
+		source_dir = os.path.dirname(os.path.abspath(reference_fasta))
+		for name in list(missing):
+			existing = existing_piece(pieces[name][0], source_dir, fasta_record[1])
+			if not existing or source_dir == directory: continue
+			print(f"using the {name} index found in {source_dir}")
+			# not made read-only: the files are shared with the original (as hardlinks, or through the symlinks)
+			import_piece(pieces[name][0], existing)
+			for path in pieces[name][0]: manifest["files"][os.path.basename(path)] = file_record(path)
+			missing.remove(name)
+		if missing:
+			print(f"indexing {reference_fasta}: {missing}")
+			with ThreadPoolExecutor(len(missing)) as executor:
+				retcodes = list(executor.map(lambda name: build_piece(*pieces[name]), missing))
+			failed = [name for name, retcode in zip(missing, retcodes) if retcode != 0]
+			for name in missing:
+				if name in failed: continue
+				for path in pieces[name][0]:
+					os.chmod(path, 0o444)
+					manifest["files"][os.path.basename(path)] = file_record(path)
+		else:
+			failed = []
+		write_manifest(manifest_file, manifest)
+
+	if failed:
+		print(f"indexing {reference_fasta} failed: {failed}")
+		exit(1)
+	return fasta
+
+
+def bwa_shm_loaded(bwa, fasta):
+	# bwa shm keeps the indices under the basename of the index prefix
+	output = subprocess.run(["bash", "-c", f"{bwa} shm -l 2> /dev/null"], stdout=subprocess.PIPE).stdout.decode()
+	return os.path.basename(fasta) in [line.split("\t")[0] for line in output.splitlines()]
+
+
+def bwa_shm_load(bwa, fasta):
+	# returns True if we loaded the index, False if it was there already
+	# (the lock, because the alignments of several samples might start at the same time; the shared memory
+	# belongs to the host, so the lock is in its temporary directory, not in the - possibly read-only - cache)
+	with open(f"{tempfile.gettempdir()}/bwa_shm.{os.path.basename(fasta)}.lock", "a") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		if bwa_shm_loaded(bwa, fasta): return False
+		cmd = f"{bwa} shm {fasta} 2> /dev/null"
+		print(cmd)
+		if subprocess.call(["bash", "-c", cmd]) != 0:
+			print(f"failed to load the index of {fasta} into shared memory")
+			exit(1)
+	return True
+
+
+def bwa_shm_drop(bwa):
+	cmd = f"{bwa} shm -d 2> /dev/null"
+	print(cmd)
+	subprocess.call(["bash", "-c", cmd])
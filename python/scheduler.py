@@ -0,0 +1,86 @@
+
+
+""" Dependency-aware parallel execution of pipeline jobs
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+"""
+
+import subprocess, os, heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Job:
+	def __init__(self, name, cmd, weight=1):
+		self.name   = name
+		self.cmd    = cmd     # list of command line arguments
+		self.weight = weight  # rough relative running time, used only to prioritize
+		self.deps   = set()   # names of the jobs this one has to wait for
+		# what the result of the job depends on and what it produces (see buildcache.py)
+		self.inputs  = []     # glob patterns
+		self.outputs = []     # glob patterns
+		self.listed_outputs = []  # output files that name further outputs
+		self.tools   = []     # Config field names of the executables
+		self.config_fields = []
+
+
+def critical_path(jobs):
+	# the length of the longest chain of jobs that (including the job itself)
+	# still has to run once the job is started; we start the longest chains first
+	dependents = {name: [] for name in jobs}
+	for job in jobs.values():
+		for dep in job.deps: dependents[dep].append(job.name)
+	length = {}
+	def chain_length(name):
+		if name not in length:
+			length[name] = jobs[name].weight + max([chain_length(d) for d in dependents[name]], default=0)
+		return length[name]
+	for name in jobs: chain_length(name)
+	return length
+
+
+def run_job(job, log_dir, cwd, cache):
+	# returns [exit code, was the job skipped]
+	if cache:
+		# the upstream jobs are done at this point, so the inputs are final
+		if cache.up_to_date(job, cache.signature(job)): return [0, True]
+		cache.forget(job)
+	# the output of the jobs running in parallel would be unreadable if interleaved
+	with open(f"{log_dir}/{job.name}.log", "w") as log:
+		retcode = subprocess.call(job.cmd, stdout=log, stderr=subprocess.STDOUT, cwd=cwd)
+	if cache and retcode == 0: cache.record(job)
+	return [retcode, False]
+
+
+def run_jobs(jobs, max_workers, log_dir, cwd=None, cache=None):
+	os.makedirs(log_dir, exist_ok=True)
+	priority = critical_path(jobs)
+	waiting  = {name: set(job.deps) for name, job in jobs.items()}
+	ready    = [(-priority[name], name) for name, deps in waiting.items() if not deps]
+	heapq.heapify(ready)
+	running  = {}
+	failed   = []
+	with ThreadPoolExecutor(max_workers) as executor:
+		while ready or running:
+			while ready and len(running) < max_workers:
+				name = heapq.heappop(ready)[1]
+				print(f"starting {name}")
+				running[executor.submit(run_job, jobs[name], log_dir, cwd, cache)] = name
+			done = wait(running, return_when=FIRST_COMPLETED)[0]
+			for future in done:
+				name = running.pop(future)
+				[retcode, skipped] = future.result()
+				if retcode != 0:
+					# whatever depends on this job will never be ready
+					print(f"{name} failed (exit code {retcode}), see {log_dir}/{name}.log")
+					failed.append(name)
+					continue
+				print(f"{name} {'up to date' if skipped else 'done'}")
+				for other, deps in waiting.items():
+					if name not in deps: continue
+					deps.remove(name)
+					if not deps: heapq.heappush(ready, (-priority[other], other))
+
+	not_run = [name for name, deps in waiting.items() if deps]
+	return [failed, not_run]
@@ -15,7 +15,9 @@ class Styling:
 		if workbook:
 			self.xlsx_format = {"header":workbook.add_format({'align': 'center',  'valign': 'vcenter',
 															  'bold': True, 'text_wrap': True}),
-								"red_border":workbook.add_format({'border': 5, 'border_color': 'red'}),
+								"red_border":workbook.add_format({'border': 5, 'border_color': 'red', 'num_format': '0'}),
+								"integer":workbook.add_format({'num_format': '0'}),
+								"fraction":workbook.add_format({'num_format': '0.00'}),
 								"wordwrap":workbook.add_format({'align': 'left', 'text_wrap': True}),
 								"hyperlink":workbook.add_format({'align': 'center', 'color': 'blue',
 																 'underline': 1, 'valign': 'vcenter'})}
@@ -0,0 +1,174 @@
+
+
+""" Reading the regions of a bgzipped, indexed vcf
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+bcftools index writes a .csi index (or a .tbi, with -t) for a vcf.gz.
+Both divide each chromosome into a hierarchy of bins (the smallest
+spanning 2^14 bases, each level 8 times larger than the one below it),
+and list, for each bin, the chunks of the file - pairs of BGZF virtual
+offsets - holding the records that fall in the bin. For a region we
+compute the bins that can overlap it (reg2bins), read only the chunks
+listed for them, and keep the records that actually overlap the region.
+The chromosome names are in the tabix header, which in a .csi is stored
+as its auxiliary data.
+
+The readers, each with its cache of decompressed blocks, are kept for
+the following lookups in the same file (the 16 most recently used), and
+are replaced when the file changes.
+
+Sources:
+https://samtools.github.io/hts-specs/CSIv1.pdf
+https://samtools.github.io/hts-specs/tabix.pdf
+
+"""
+
+import gzip, os, struct
+from collections import OrderedDict
+
+from bgzf import BgzfReader
+
+
+def reg2bins(beg, end, min_shift, depth):
+	# the bins that may hold the records overlapping [beg, end) (0-based)
+	bins = []
+	end -= 1
+	shift = min_shift + depth*3
+	first_bin = 0
+	for level in range(depth + 1):
+		bins += range(first_bin + (beg >> shift), first_bin + (end >> shift) + 1)
+		shift -= 3
+		first_bin += 1 << (level*3)
+	return bins
+
+
+def parse_names(data, offset):
+	# the tabix header: format, sequence/begin/end columns, meta character, lines to skip, and the names
+	[fmt, col_seq, col_beg, col_end, meta, skip, l_nm] = struct.unpack_from("<7i", data, offset)
+	names = data[offset+28:offset+28+l_nm].split(b"\0")
+	return [[name.decode() for name in names if name], offset + 28 + l_nm]
+
+
+def parse_bins(data, offset, csi):
+	# bin -> list of chunks [begin, end], for one sequence, and the offset past it
+	[n_bin] = struct.unpack_from("<i", data, offset)
+	offset += 4
+	bins = {}
+	for i in range(n_bin):
+		if csi:
+			[bin_number, loffset, n_chunk] = struct.unpack_from("<IQi", data, offset)
+			offset += 16
+		else:
+			[bin_number, n_chunk] = struct.unpack_from("<Ii", data, offset)
+			offset += 8
+		chunks = struct.unpack_from(f"<{2*n_chunk}Q", data, offset)
+		offset += 16*n_chunk
+		bins[bin_number] = [[chunks[2*j], chunks[2*j+1]] for j in range(n_chunk)]
+	if not csi:
+		# the linear index of .tbi - not needed, the bins are enough
+		[n_intv] = struct.unpack_from("<i", data, offset)
+		offset += 4 + 8*n_intv
+	return [bins, offset]
+
+
+def read_index(index_file):
+	# returns [min_shift, depth, {chromosome name: bins}]
+	data = gzip.decompress(open(index_file, "rb").read())
+	magic = data[:4]
+	if magic == b"CSI\1":
+		[min_shift, depth, l_aux] = struct.unpack_from("<3i", data, 4)
+		if l_aux < 28:
+			print(f"{index_file}: no chromosome names in the index (not a vcf index?)")
+			exit(1)
+		names = parse_names(data, 16)[0]
+		[n_ref] = struct.unpack_from("<i", data, 16 + l_aux)
+		offset = 20 + l_aux
+		csi = True
+	elif magic == b"TBI\1":
+		# in .tbi the number of sequences comes before the header
+		[min_shift, depth] = [14, 5]
+		[n_ref] = struct.unpack_from("<i", data, 4)
+		[names, offset] = parse_names(data, 8)
+		csi = False
+	else:
+		print(f"{index_file} is not a .csi or .tbi index")
+		exit(1)
+	sequences = {}
+	for name in names[:n_ref]:
+		[sequences[name], offset] = parse_bins(data, offset, csi)
+	return [min_shift, depth, sequences]
+
+
+def index_file_of(vcf_file):
+	# bcftools index writes .csi by default, .tbi with -t; None if the vcf is not indexed
+	for index_file in [vcf_file + ".csi", vcf_file + ".tbi"]:
+		if os.path.exists(index_file): return index_file
+	return None
+
+
+def record_end(fields):
+	# the last position of a record: END from INFO if given (structural variants, gVCF blocks), otherwise from REF
+	for item in fields[7].split(";") if len(fields) > 7 else []:
+		if item.startswith("END="): return int(item[4:])
+	return int(fields[1]) + len(fields[3]) - 1
+
+
+class TabixReader:
+	def __init__(self, vcf_file, index_file=None):
+		if index_file is None: index_file = index_file_of(vcf_file)
+		if index_file is None:
+			print(f"no .csi or .tbi index found for {vcf_file}")
+			exit(1)
+		[self.min_shift, self.depth, self.sequences] = read_index(index_file)
+		self.reader = BgzfReader(vcf_file)
+
+	def close(self):
+		self.reader.close()
+
+	def chunks(self, chrom, beg, end):
+		# the chunks to read for [beg, end), sorted and with the overlapping ones merged
+		bins = self.sequences.get(chrom, {})
+		chunks = sorted([chunk for b in reg2bins(beg, end, self.min_shift, self.depth) for chunk in bins.get(b, [])])
+		merged = []
+		for [chunk_beg, chunk_end] in chunks:
+			if merged and chunk_beg <= merged[-1][1]:
+				merged[-1][1] = max(merged[-1][1], chunk_end)
+			else:
+				merged.append([chunk_beg, chunk_end])
+		return merged
+
+	def fetch(self, chrom, start, end):
+		# yields the records (lists of vcf fields, as strings) overlapping start-end (1-based, closed,
+		# as in bcftools view -r chrom:start-end)
+		for [chunk_beg, chunk_end] in self.chunks(chrom, start-1, end):
+			for line in self.reader.lines(chunk_beg, chunk_end):
+				fields = line.decode().split("\t")
+				if fields[0] != chrom or fields[0][0] == "#": continue
+				position = int(fields[1])
+				if position > end: break  # sorted - nothing more in this chunk
+				if record_end(fields) >= start: yield fields
+
+
+max_readers = 16
+readers = OrderedDict()  # [path, size, mtime] -> TabixReader, the most recently used last
+
+
+def tabix_reader(vcf_file):
+	# a reader is reused only as long as the file is the same - a rewritten vcf gets a new one
+	path = os.path.abspath(vcf_file)
+	stat = os.stat(path)
+	key  = (path, stat.st_size, stat.st_mtime_ns)
+	if key in readers:
+		readers.move_to_end(key)
+		return readers[key]
+	for stale in [k for k in readers if k[0] == path]: readers.pop(stale).close()
+	readers[key] = TabixReader(vcf_file)
+	while len(readers) > max_readers: readers.popitem(last=False)[1].close()
+	return readers[key]
+
+
+def vcf_region(vcf_file, chrom, start, end):
+	# the records of vcf_file overlapping chrom:start-end
+	return list(tabix_reader(vcf_file).fetch(chrom, start, end))
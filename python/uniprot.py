@@ -0,0 +1,122 @@
+
+
+""" Gene name lookup in the uniprot table
+
+Part of seqinspector toy NGS QC pipeline
+Ivana Mihalek,  2020
+
+The uniprot table (Config.basic_uniprot) has one line per protein:
+uniprot id, protein name, gene names (the first should be hgnc;
+but then several genes can correspond to the same protein, e.g. histones),
+length, expression tissue, involvement in disease.
+Rather than reading it whole for each report, we build once an SQLite
+index (Config.uniprot_index) with the already parsed entries, and each
+gene name - every alias on the gene names list - pointing to its entry.
+If a gene name appears on more than one line, the last one wins, as it
+did when the table was read line by line. The size and the modification
+time of the table are stored in the index, and if they do not match,
+the index is rebuilt.
+
+"""
+
+import fcntl, os, sqlite3
+from contextlib import closing
+
+from config import Config
+
+
+def shorten_disease_string(disease_str, split_on):
+	# if there are more than 100 characters, take only the first 100
+	# if there are more than three sentences, take only first three
+	return ".".join(disease_str.split(split_on)[0].replace("Note=","")[:100] .strip().split(".")[:3])
+
+
+def disease_parse(uniprot_disease_string):
+	if not uniprot_disease_string: return "unknown"
+	if "[MIM" in uniprot_disease_string:
+		split_on = "[MIM"
+	else:
+		split_on = "."
+	diseases  = [shorten_disease_string(substr, split_on) for substr in uniprot_disease_string.split("DISEASE:")[1:]]
+	return "; ".join(diseases)
+
+
+def source_stamp(uniprot_info):
+	stat = os.stat(uniprot_info)
+	return f"{os.path.abspath(uniprot_info)} {stat.st_size} {stat.st_mtime_ns}"
+
+
+def index_stamp(index_file):
+	# the stamp of the table the index was built from (None if there is no usable index)
+	if not os.path.exists(index_file): return None
+	try:
+		with closing(sqlite3.connect(index_file)) as db:
+			return db.execute("select value from meta where key = 'source'").fetchone()[0]
+	except (sqlite3.Error, TypeError):
+		return None
+
+
+def uniprot_entries(uniprot_info):
+	# yields [uniprot id, protein name, expression, disease, gene names]
+	with open(uniprot_info) as inf:
+		for line in inf:
+			field = line.strip().split("\t")
+			if len(field)<6: continue
+			if len(field[2].replace(" ", "")) == 0: continue
+			gene_names = set([x.strip(";,") for x in field[2].split()])
+			yield [field[0], field[1].split("(")[0].strip(), field[4].replace("TISSUE SPECIFICITY: ",""),
+					disease_parse(field[5]), gene_names]
+
+
+def build_uniprot_index(uniprot_info, index_file):
+	print(f"indexing {uniprot_info}")
+	tmp_file = f"{index_file}.tmp"
+	if os.path.exists(tmp_file): os.remove(tmp_file)
+	db = sqlite3.connect(tmp_file)
+	db.execute("create table meta (key text primary key, value text)")
+	db.execute("create table entry (id integer primary key, uniprot text, name text, expression text, disease text)")
+	db.execute("create table alias (gene text primary key, entry integer) without rowid")
+	for [number, [uniprot, name, expression, disease, gene_names]] in enumerate(uniprot_entries(uniprot_info)):
+		db.execute("insert into entry values (?, ?, ?, ?, ?)", [number, uniprot, name, expression, disease])
+		# replace: the last line with the gene name wins
+		db.executemany("insert or replace into alias values (?, ?)", [[gene, number] for gene in gene_names])
+	db.execute("insert into meta values ('source', ?)", [source_stamp(uniprot_info)])
+	db.commit()
+	db.close()
+	os.replace(tmp_file, index_file)
+
+
+def uniprot_index(uniprot_info=None, index_file=None):
+	# the path to the index, (re)built if needed
+	if uniprot_info is None: uniprot_info = Config.basic_uniprot
+	if index_file is None: index_file = Config.uniprot_index
+	os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+	with open(f"{index_file}.lock", "a") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file is closed
+		if index_stamp(index_file) != source_stamp(uniprot_info):
+			build_uniprot_index(uniprot_info, index_file)
+	return index_file
+
+
+def find_description(uniprot_info, gene_symbols, index_file=None):
+	# returns [name, expression, disease, uniprot], each a dict keyed by gene symbol,
+	# for the gene symbols found in the table
+	name = {}
+	expression = {}
+	uniprot = {}
+	disease = {}
+	gene_symbols = sorted(set(gene_symbols))
+	# closing: sqlite3 connection as a context manager only ends the transaction, it does not close
+	with closing(sqlite3.connect(uniprot_index(uniprot_info, index_file))) as db:
+		# sqlite has a limit on the number of parameters in a single query
+		for i in range(0, len(gene_symbols), 500):
+			batch = gene_symbols[i:i+500]
+			query = "select alias.gene, entry.uniprot, entry.name, entry.expression, entry.disease " \
+					"from alias join entry on alias.entry = entry.id " \
+					f"where alias.gene in ({','.join('?'*len(batch))})"
+			for [hgnc, uniprot_id, protein_name, tissue, disease_str] in db.execute(query, batch):
+				uniprot[hgnc]    = uniprot_id
+				name[hgnc]       = protein_name
+				expression[hgnc] = tissue
+				disease[hgnc]    = disease_str
+	return [name, expression, disease, uniprot]
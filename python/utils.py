@@ -7,7 +7,7 @@ Ivana Mihalek,  2020
 
 """
 
-import os, sys
+import os, re, subprocess, sys
 from config import Config
 
 def get_home_path():
@@ -22,16 +22,104 @@ def check_exist(dependencies):
 			print("Also note the expected directory tree for this project:", Config.dirtree)
 			print("The pipeline should be run in the enumerated order ")
 			print("- some files might be missing because they were not created yet.")
-			exit()
+			exit(1)  # nonzero, so that the pipeline runner does not start the stages that depend on this one
+
+
+def run_or_exit(cmd, failure, outputs=[]):
+	# runs the (bash) command, and if it fails, removes whatever it left of its outputs and exits with nonzero,
+	# as check_exist does (called from a worker thread, the exit is re-raised by the future's result())
+	print(cmd)
+	if subprocess.call(["bash", "-c", cmd]) != 0:
+		print(failure)
+		for fnm in outputs:
+			if os.path.exists(fnm): os.remove(fnm)
+		exit(1)
+
+
+def get_rootnames():
+	# the pipeline runner (00_run_pipeline.py) passes the sample(s) to process
+	# on the command line; when a stage is run by hand, it processes all samples
+	if len(sys.argv) > 1: return sys.argv[1:]
+	return Config.paired_reads_rootnames
+
+
+# the rootnames in Config.paired_reads_rootnames are per lane, e.g. AH_S1_L001;
+# the lanes are processed separately up to the alignment, and merged into the sample, AH_S1, after that
+lane_suffix = re.compile(r"_L\d{3}$")
+
+
+def sample_name(root):
+	return lane_suffix.sub("", root)
+
+
+def group_lanes(rootnames):
+	# sample name -> its lane rootnames, in the order they were given
+	lanes = {}
+	for root in rootnames:
+		lanes.setdefault(sample_name(root), []).append(root)
+	return lanes
+
+
+def get_samples():
+	# for the stages after the lanes are merged; the runner passes the sample names,
+	# but lane rootnames are fine too
+	return list(group_lanes(get_rootnames()).keys())
+
+
+def sample_lanes(sample):
+	return [root for root in Config.paired_reads_rootnames if sample_name(root) == sample]
+
+
+def target_file(dna_dir, sample):
+	# the target regions for a sample, e.g. AH_S1_target.txt
+	return f"{dna_dir}/{sample}_target.txt"
+
+
+def trimming_record(clean_dir, root):
+	# written by the adapter cleanup for each lane, trimmed or not: the trimmed fastq files, if any,
+	# one per line, with the adapters removed from them
+	return f"{clean_dir}/{root}.trimming.tsv"
+
+
+def listed_files(record):
+	# the files named in the first column of a record (relative to its directory), skipping the # lines
+	directory = os.path.dirname(record)
+	with open(record) as inf:
+		return [f"{directory}/{line.split()[0]}" for line in inf if line.strip() and line[0] != "#"]
 
 
 def check_fastq_exist(dna_dir):
 	for root in Config.paired_reads_rootnames:
 		for label in Config.read_labels:
-			fastq = f"{dna_dir}/{root}_{label}.fastq"
+			fastq = fastq_file(dna_dir, root, label)
 			if not os.path.exists(fastq):
 				print(f"{fastq} not found.")
-				exit()
+				exit(1)
+
+
+# the input fastq can be plain, gzipped or bgzipped, and the trimmed fastq are written compressed;
+# the first extension found on disk is used
+fastq_extensions = [".fastq", ".fastq.gz", ".fastq.bgz"]
+
+
+def fastq_file(fastq_dir, root, label):
+	for extension in fastq_extensions:
+		fastq = f"{fastq_dir}/{root}_{label}{extension}"
+		if os.path.exists(fastq): return fastq
+	return f"{fastq_dir}/{root}_{label}{fastq_extensions[0]}"  # not there, but something for the error message
+
+
+def gz_alias(fastq, alias_dir):
+	# FastQC and cutadapt recognize gzipped input by the .gz extension - bgzipped is gzipped, too,
+	# so we give them a symlink by that name (FastQC names its output after the file it was given)
+	if not fastq.endswith(".bgz"): return fastq
+	alias = f"{alias_dir}/{os.path.basename(fastq)[:-len('.bgz')]}.gz"
+	if not os.path.lexists(alias): os.symlink(os.path.abspath(fastq), alias)
+	return alias
+
+
+# the bam file 05_alignment.py produces, for each Config.alignment_output
+alignment_suffixes = {"sam": ".bam", "bam": ".bam", "sorted": ".sort.bam", "sharded": ".sort.bam"}
 
 
 def fastqc_dir(fastqc_out_dir, root, label):